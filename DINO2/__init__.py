@@ -32,4 +32,4 @@ class Database:
         self.Session.configure(bind=self.engine)
 
 
-from . import model, tools, types
+from . import model, timetable, tools, types
@@ -24,22 +24,22 @@ Data model for DINO 2.1 data
 from __future__ import annotations
 
 from datetime import date
-from sqlalchemy import Column, String, Integer, Boolean, inspect
+from sqlalchemy import Column, String, Integer, Boolean, event, inspect
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.types import TypeEngine
 from sqlalchemy.orm import relationship, RelationshipProperty
 from sqlalchemy.orm.session import Session
-from typing import Optional, Collection, Tuple, TYPE_CHECKING, Any, Dict
+from typing import Optional, Collection, Tuple, TYPE_CHECKING, Any, Callable, Dict, TypeVar
 
 from ..types import DinoDate
 
 if TYPE_CHECKING:
-    from .calendar import DayType, DayAttribute, DayGrouping, CalendarDay, Restriction
+    from .calendar import DayType, DayAttribute, DayGrouping, CalendarDay, Restriction, RestrictionDay
     from .fares import FareZone, NeighbourFareZone
-    from .location import Stop, StopAliasPlacename, StopAdditionalName, StopArea, StopPoint, Link, LinkGeometryPoint, LinkForcePoint
+    from .location import Stop, StopAliasPlacename, StopAdditionalName, StopArea, StopPoint, Link, LinkGeometryPoint, LinkForcePoint, LinkLookup, LinkGeometryStore
     from .operational import Branch, Operator, OperatorBranchOffice, MeansOfTransportDesc, VehicleType, VehicleDestinationText
-    from .network import Course, CourseStop, CourseStopTiming
-    from .schedule import Notice, Trip, StopConstraint, TripVDT
+    from .network import Course, CourseStop, CourseStopTiming, StopTimePatterns
+    from .schedule import Notice, Trip, StopConstraint, TripVDT, ServiceDays
 
 
 class DinoBase:
@@ -91,6 +91,24 @@ class DinoBase:
 Base = declarative_base(cls=DinoBase)
 
 
+_T = TypeVar("_T")
+
+
+def session_cached(session: Session, key: str, compute: Callable[[], _T]) -> _T:
+    """Result of `compute` kept in `session.info` under `key` until the session flushes, commits or rolls back"""
+    cache = session.info.setdefault("DINO2_cache", {})
+    if key not in cache:
+        cache[key] = compute()
+    return cache[key]
+
+
+@event.listens_for(Session, "after_flush")
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _clear_session_cache(session: Session, *args) -> None:
+    session.info.pop("DINO2_cache", None)
+
+
 class Version(Base):
     """
     Central class for timetable base versions.
@@ -136,6 +154,8 @@ class Version(Base):
     """List of `calendar.CalendarDay`s of this version"""
     restrictions: RelationshipProperty[Collection[Restriction]] = relationship("Restriction", back_populates="version")
     """List of `calendar.Restriction`s of this version"""
+    restriction_days: RelationshipProperty[Collection[RestrictionDay]] = relationship("RestrictionDay", viewonly=True)
+    """List of `calendar.RestrictionDay`s of this version (if materialized on import)"""
 
     farezones: RelationshipProperty[Collection[FareZone]] = relationship("FareZone", back_populates="version")
     """List of `fares.FareZone`s of this version"""
@@ -188,6 +208,46 @@ class Version(Base):
     trip_vdts: RelationshipProperty[Collection[TripVDT]] = relationship("TripVDT", viewonly=True)
     """List of `schedule.TripVDT`s of this version"""
 
+    _service_days: Optional[ServiceDays] = None
+
+    @property
+    def service_days(self) -> ServiceDays:
+        """`schedule.ServiceDays` of all trips of this version, computed once per instance"""
+        if self._service_days is None:
+            from .schedule import ServiceDays
+            self._service_days = ServiceDays.for_version(self._session, self.id)
+        return self._service_days
+
+    _stop_time_patterns: Optional[StopTimePatterns] = None
+
+    @property
+    def stop_time_patterns(self) -> StopTimePatterns:
+        """`network.StopTimePatterns` of all courses of this version, computed once per instance"""
+        if self._stop_time_patterns is None:
+            from .network import StopTimePatterns
+            self._stop_time_patterns = StopTimePatterns.for_version(self._session, self.id)
+        return self._stop_time_patterns
+
+    _link_lookup: Optional[LinkLookup] = None
+
+    @property
+    def link_lookup(self) -> LinkLookup:
+        """`location.LinkLookup` of this version, kept per instance"""
+        if self._link_lookup is None:
+            from .location import LinkLookup
+            self._link_lookup = LinkLookup(self._session, self.id)
+        return self._link_lookup
+
+    _link_geometry: Optional[LinkGeometryStore] = None
+
+    @property
+    def link_geometry(self) -> LinkGeometryStore:
+        """`location.LinkGeometryStore` of all links of this version, parsed once per instance"""
+        if self._link_geometry is None:
+            from .location import LinkGeometryStore
+            self._link_geometry = LinkGeometryStore.for_version(self._session, self.id)
+        return self._link_geometry
+
     def __repr__(self) -> str:
         return f"<Version(id={self.id}, desc={self.desc}, period={self.period}, period_name={self.period_name}, date_from={self.date_from}, date_to={self.date_to}, net={self.net}, priority={self.priority})>"
 
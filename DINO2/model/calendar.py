@@ -3,16 +3,190 @@
 
 from __future__ import annotations
 
-from calendar import monthrange, month_abbr
+from calendar import month_abbr
 from collections import UserString
 from datetime import date, timedelta
-from sqlalchemy import Column, String, Integer, ForeignKey, ForeignKeyConstraint, and_
+from functools import lru_cache
+from numpy import arange, array, concatenate, count_nonzero, datetime64, flatnonzero, frombuffer, full, int64, ndarray, repeat, uint32, zeros
+from sqlalchemy import Column, String, Integer, ForeignKey, ForeignKeyConstraint, Index, and_
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import composite, CompositeProperty, relationship, RelationshipProperty
-from typing import Optional, Tuple, Set, FrozenSet, TYPE_CHECKING, Sequence
+from typing import Optional, Tuple, FrozenSet, TYPE_CHECKING, Sequence, Iterable, Iterator, Union, Dict, Any
 
 from ..types import DinoDate
-from . import Base, Version
+from . import Base, Version, session_cached
+
+
+class DayBitset:
+    """
+    Immutable set of days, stored as the ordinal (see `datetime.date.toordinal`) of its first day and a boolean array over the following days
+
+    Supports membership tests, intersection (`&`) and union (`|`) with other `DayBitset`s or sets of dates, and counting (`len`).
+    """
+    __slots__ = ("start", "bits", "_dates")
+
+    def __init__(self, start: int, bits: ndarray):
+        self.start = start
+        """Ordinal of the day of `bits[0]`"""
+        self.bits = bits.astype(bool)
+        """Day flags"""
+        self.bits.flags.writeable = False
+        self._dates: Optional[FrozenSet[date]] = None
+
+    @classmethod
+    def from_dates(cls, dates: Iterable[date]) -> DayBitset:
+        """`DayBitset` of the given dates"""
+        ordinals = array(sorted(d.toordinal() for d in dates), dtype=int)
+        if not len(ordinals):
+            return cls(0, zeros(0, dtype=bool))
+        bits = zeros(ordinals[-1] - ordinals[0] + 1, dtype=bool)
+        bits[ordinals - ordinals[0]] = True
+        return cls(int(ordinals[0]), bits)
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def from_daystring(daystring: str, date_from: date, date_until: date) -> DayBitset:
+        """
+        Decode a `Restriction.daystring`, limited to `date_from` until `date_until` (cached)
+
+        Each group of 8 hex digits holds the days of one month, starting with the month of `date_from`,
+        day 1 being the least significant bit, and the most significant bit being unused.
+        """
+        months = frombuffer(bytes.fromhex(daystring), dtype=">u4").astype(uint32)
+        first_month = datetime64(f"{date_from.year:04}-{date_from.month:02}", "M") + arange(len(months))
+        days_in_month = ((first_month + 1).astype("M8[D]") - first_month.astype("M8[D]")).astype(int)
+        # day d of each month, for all days of the months
+        day = arange(days_in_month.sum()) - repeat(concatenate(([0], days_in_month.cumsum()[:-1])), days_in_month)
+        bits = (repeat(months, days_in_month) >> day.astype(uint32)) & 1
+        start = date_from.replace(day=1).toordinal()
+        lo, hi = date_from.toordinal() - start, date_until.toordinal() - start + 1
+        return DayBitset(date_from.toordinal(), bits[lo:max(lo, hi)])
+
+    @property
+    def first(self) -> Optional[date]:
+        """First day in this set"""
+        days = flatnonzero(self.bits)
+        return date.fromordinal(self.start + int(days[0])) if len(days) else None
+
+    @property
+    def last(self) -> Optional[date]:
+        """Last day in this set"""
+        days = flatnonzero(self.bits)
+        return date.fromordinal(self.start + int(days[-1])) if len(days) else None
+
+    @property
+    def dates(self) -> FrozenSet[date]:
+        """Days as a set of `datetime.date`s"""
+        if self._dates is None:
+            self._dates = frozenset(self)
+        return self._dates
+
+    def window(self, start: int, stop: int) -> ndarray:
+        """Bits for the days with ordinals from `start` until before `stop`"""
+        window = zeros(max(stop - start, 0), dtype=bool)
+        lo, hi = max(start, self.start), min(stop, self.start + len(self.bits))
+        if lo < hi:
+            window[lo - start:hi - start] = self.bits[lo - self.start:hi - self.start]
+        return window
+
+    def count(self, date_from: Optional[date] = None, date_until: Optional[date] = None) -> int:
+        """Number of days, optionally only from `date_from` and/or until `date_until`"""
+        start = date_from.toordinal() if date_from else self.start
+        stop = date_until.toordinal() + 1 if date_until else self.start + len(self.bits)
+        return int(count_nonzero(self.window(start, stop)))
+
+    def __contains__(self, day: date) -> bool:
+        i = day.toordinal() - self.start
+        return 0 <= i < len(self.bits) and bool(self.bits[i])
+
+    def __iter__(self) -> Iterator[date]:
+        return (date.fromordinal(self.start + int(i)) for i in flatnonzero(self.bits))
+
+    def __len__(self) -> int:
+        return int(count_nonzero(self.bits))
+
+    def __and__(self, other: Union[DayBitset, Iterable[date]]) -> DayBitset:
+        other = other if isinstance(other, DayBitset) else DayBitset.from_dates(other)
+        start, stop = max(self.start, other.start), min(self.start + len(self.bits), other.start + len(other.bits))
+        return DayBitset(start, self.window(start, stop) & other.window(start, stop))
+
+    def __or__(self, other: Union[DayBitset, Iterable[date]]) -> DayBitset:
+        other = other if isinstance(other, DayBitset) else DayBitset.from_dates(other)
+        if not len(other.bits):
+            return self
+        if not len(self.bits):
+            return other
+        start, stop = min(self.start, other.start), max(self.start + len(self.bits), other.start + len(other.bits))
+        return DayBitset(start, self.window(start, stop) | other.window(start, stop))
+
+    __rand__ = __and__
+    __ror__ = __or__
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, DayBitset):
+            return self.dates == other.dates
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self.dates)
+
+    def __repr__(self) -> str:
+        return f"<DayBitset(first={self.first}, last={self.last}, days={len(self)})>"
+
+
+class VersionCalendar:
+    """
+    Effective `DINO2.model.Version` per date and `DINO2.model.Version.net`
+
+    On each date, of the versions of a net whose period (`DINO2.model.Version.date_from` until `DINO2.model.Version.date_to`, open if missing) contains it,
+    the one with the highest `DINO2.model.Version.priority` wins (missing priorities rank lowest), then the one with the latest `date_from`, then the highest id.  
+    Held as an array of version ids with one row per net and one column per day between the earliest and the latest period bound.
+    """
+    def __init__(self, versions: Iterable[Version]):
+        def rank(v: Version) -> Tuple[bool, int, int, int]:
+            return (v.priority is not None, v.priority or 0, v.date_from.toordinal() if v.date_from else 0, v.id)
+        self.versions: Dict[Optional[str], Tuple[Tuple[int, int, int], ...]] = {}
+        """Per net: (version id, first day ordinal, last day ordinal) of each version, lowest ranking first"""
+        for v in sorted(versions, key=rank):
+            self.versions[v.net] = self.versions.get(v.net, ()) + ((
+                v.id, v.date_from.toordinal() if v.date_from else date.min.toordinal(), v.date_to.toordinal() if v.date_to else date.max.toordinal()),)
+        self.nets = {net: i for i, net in enumerate(self.versions)}
+        """Row of each net"""
+        bounds = [o for periods in self.versions.values() for (_, lo, hi) in periods for o in (lo, hi) if o not in (date.min.toordinal(), date.max.toordinal())]
+        self.start = min(bounds, default=0)
+        """Ordinal of the first day of `table`"""
+        self.table = full((len(self.nets), max(bounds, default=-1) - self.start + 1), -1, dtype=int64)
+        """Winning version id per net and day, -1 if none"""
+        for net, periods in self.versions.items():
+            for version_id, lo, hi in periods:
+                self.table[self.nets[net], max(lo - self.start, 0):max(hi - self.start + 1, 0)] = version_id
+
+    @classmethod
+    def for_session(cls, session) -> VersionCalendar:
+        """`VersionCalendar` of all versions in the database, kept by the session until its next flush, commit or rollback (see `DINO2.model.session_cached`)"""
+        return session_cached(session, "version_calendar", lambda: cls(session.query(Version).all()))
+
+    def version_for(self, day: date, net: Optional[str] = None) -> Optional[int]:
+        """Id of the effective version of `net` on `day`"""
+        if net not in self.nets:
+            return None
+        d = day.toordinal()
+        if 0 <= d - self.start < self.table.shape[1]:
+            version_id = int(self.table[self.nets[net], d - self.start])
+            return version_id if version_id != -1 else None
+        # outside of all finite periods, only open periods can match
+        return next((version_id for version_id, lo, hi in reversed(self.versions[net]) if lo <= d <= hi), None)
+
+    def versions_for(self, day: date) -> FrozenSet[int]:
+        """Ids of the effective versions of all nets on `day`"""
+        return frozenset(v for v in (self.version_for(day, net) for net in self.nets) if v is not None)
+
+    def dates(self, version_id: int) -> DayBitset:
+        """Days within `table` on which the version with id `version_id` is effective"""
+        return DayBitset(self.start, (self.table == version_id).any(axis=0))
+
+    def __repr__(self) -> str:
+        return f"<VersionCalendar(nets={len(self.nets)}, start={date.fromordinal(self.start) if self.table.shape[1] else None}, days={self.table.shape[1]})>"
 
 
 class DayType(Base):
@@ -83,6 +257,11 @@ class DayAttribute(Base):
         """Valid dates of the day types that belong to this day attribute grouping"""
         return frozenset(cd.day for cd in self.days)
 
+    @property
+    def bitset(self) -> DayBitset:
+        """`dates` as `DayBitset`"""
+        return DayBitset.from_dates(cd.day for cd in self.days)
+
     def __repr__(self) -> str:
         return f"<DayAttribute(version_id={self.version_id}, id={self.id}, text={self.text}, abbr={self.abbr})>"
 
@@ -233,29 +412,17 @@ class Restriction(Base):
     @staticmethod
     def calc_dateset(daystring: str, date_from: date, date_until: date) -> FrozenSet[date]:
         """Get valid dates for given restriction string and start/end date"""
-        dates: Set[date] = set()
-        currentyear, currentmonth = date_from.year, date_from.month
-        firstday, lastday = date_from.day, date_until.day
-        for o in range(0, len(daystring), 8):
-            bits = bin(int(daystring[o:o+8], 16))[2:].zfill(32)[1:][::-1]
-            if currentmonth == 13:
-                currentmonth = 1
-                currentyear += 1
-            daysinmonth = monthrange(currentyear, currentmonth)[1]
-            for x in range(1, daysinmonth+1):
-                if not (((not o) and x < firstday) or (o == len(daystring) - 8 and x > lastday)) and bool(int(bits[x-1])):
-                    dates.add(date(currentyear, currentmonth, x))
-            currentmonth += 1
-        return frozenset(dates)
-
-    _dates: Optional[Tuple[str, FrozenSet[date]]] = None
+        return DayBitset.from_daystring(daystring, date_from, date_until).dates
+
+    @property
+    def bitset(self) -> DayBitset:
+        """Valid days as `DayBitset` (decoded once per `daystring`, `date_from` and `date_until`)"""
+        return DayBitset.from_daystring(self.daystring, self.date_from, self.date_until)
 
     @property
     def dates(self) -> FrozenSet[date]:
         """Valid dates"""
-        if self._dates is None or self._dates[0] != self.daystring:
-            self._dates = self.daystring, self.__class__.calc_dateset(self.daystring, self.date_from, self.date_until)
-        return self._dates[1]
+        return self.bitset.dates
 
     date_from: Column[date] = Column("DATE_FROM", DinoDate, nullable=False)
     """Date of the beginning of the restriction"""
@@ -280,8 +447,49 @@ class Restriction(Base):
         while currdate <= self.date_until:
             if currdate.day == 1:
                 text += f"\n{month_abbr[currdate.month]} {currdate.year}  "
-            text += " " if currdate < self.date_from else ("1" if currdate in self.dates else "0")
+            text += " " if currdate < self.date_from else ("1" if currdate in self.bitset else "0")
             currdate += timedelta(days=1)
         return text
 
     __abstract__ = False
+
+
+class RestrictionDay(Base):
+    """
+    Valid day of a `Restriction`
+
+    Not part of DINO 2.1: materialized from `Restriction.daystring` by `DINO2.tools.imp` (option `--restriction-days`),
+    so that queries like `DINO2.model.schedule.Trip.query_for_date` can filter by date in SQL.
+
+    Primary key: `version_id` & `restriction_id` & _`line`_ & `day`
+    """
+    _din_file = "restriction_day"
+
+    version_id: Column[int] = Column("VERSION", Integer(), ForeignKey(Version.id), primary_key=True)
+    """Version id"""
+    restriction_id: Column[str] = Column("RESTRICTION", String(length=5), primary_key=True)
+    """Restriction id"""
+    line: Column[Optional[int]] = Column("LINE_NR", Integer(), primary_key=True, nullable=True)
+    """Line for which the restriction is valid"""
+    day: Column[date] = Column("DAY", DinoDate, primary_key=True)
+    """Valid day"""
+
+    restriction: RelationshipProperty[Restriction] = relationship("Restriction", viewonly=True)
+    """`Restriction`"""
+
+    __table_args__ = (
+        ForeignKeyConstraint([version_id, restriction_id, line], [Restriction.version_id, Restriction.id, Restriction.line]),
+        Index("ix_restriction_day_day", version_id, day),
+    )
+
+    @classmethod
+    def from_restrictions(cls, restrictions: Iterable[Tuple[int, str, Optional[int], str, date, date]]) -> Iterator[Dict[str, Any]]:
+        """Rows keyed by column names for tuples of version id, id, line, daystring, date_from and date_until of `Restriction`s"""
+        for version_id, restriction_id, line, daystring, date_from, date_until in restrictions:
+            for day in DayBitset.from_daystring(daystring, date_from, date_until):
+                yield {"VERSION": version_id, "RESTRICTION": restriction_id, "LINE_NR": line, "DAY": day}
+
+    def __repr__(self) -> str:
+        return f"<RestrictionDay(version_id={self.version_id}, restriction_id={self.restriction_id}, line={self.line}, day={self.day})>"
+
+    __abstract__ = False
@@ -7,11 +7,14 @@ from collections import UserList
 from datetime import date
 import decimal
 from enum import Enum
-from sqlalchemy import Column, String, Integer, Boolean, ForeignKey, ForeignKeyConstraint, PrimaryKeyConstraint
+from sqlalchemy import Column, String, Integer, Boolean, ForeignKey, ForeignKeyConstraint, PrimaryKeyConstraint, tuple_
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.types import DECIMAL
-from sqlalchemy.orm import relationship, RelationshipProperty
-from typing import Optional, FrozenSet, TYPE_CHECKING, Sequence, Union
+from sqlalchemy.orm import relationship, RelationshipProperty, load_only
+from numpy import ascontiguousarray, concatenate, cumsum, ndarray, searchsorted, unique
+from pandas import DataFrame, concat, to_numeric
+from struct import pack
+from typing import Optional, FrozenSet, TYPE_CHECKING, Sequence, Union, Dict, Iterable, List, Set, Tuple, Type
 
 from ..types import DinoDate, IntEnum
 from . import Base, Version
@@ -561,3 +564,159 @@ class LinkForcePoint(LinkPoint):
     __abstract__ = False
     _din_file = "link_force_point.din"
     _link_bp_name = "force_points"
+
+
+LinkKey = Tuple[int, Optional[int], int, Optional[int]]
+"""(from stop id, from stop point id, to stop id, to stop point id) of a `Link`"""
+
+
+class LinkLookup:
+    """
+    `Link`s of a `DINO2.model.Version` between consecutive stop points of courses, by `LinkKey`
+
+    Links are fetched for many stop point pairs at once (see `LinkLookup.prefetch`) and kept in memory,
+    loading only their key columns (coordinates are read from the `LinkGeometryStore`).
+    Pairs without link are remembered in `missing` instead of raising.
+    """
+    def __init__(self, session, version_id: int, batchsize: int = 500):
+        self.session = session
+        self.version_id = version_id
+        """Version id"""
+        self.batchsize = batchsize
+        """Maximum number of pairs per query"""
+        self.links: Dict[LinkKey, Optional[Link]] = {}
+        """Fetched links, `None` for pairs without link"""
+        self.missing: Set[LinkKey] = set()
+        """Pairs without link"""
+
+    @staticmethod
+    def course_keys(course: Course) -> List[LinkKey]:
+        """Keys of the links between consecutive stops of `course`"""
+        return [(s_f.stop_id, s_f.stop_point_id, s_t.stop_id, s_t.stop_point_id) for s_f, s_t in zip(course.stops, course.stops[1:])]
+
+    def prefetch(self, courses: Iterable[Course]) -> None:
+        """Fetch the links of all `courses` not fetched yet"""
+        self.fetch(set(key for course in courses for key in self.course_keys(course)))
+
+    def fetch(self, keys: Iterable[LinkKey]) -> None:
+        """Fetch links by key, with one query per `batchsize` keys not fetched yet (loading only primary key and `LinkKey` columns)"""
+        keys = sorted(set(keys) - self.links.keys())
+        columns = (Link.from_stop_id, Link.from_point_id, Link.to_stop_id, Link.to_point_id)
+        for i in range(0, len(keys), self.batchsize):
+            for link in self.session.query(Link).options(load_only('from_stop_id', 'from_point_id', 'to_stop_id', 'to_point_id')) \
+                    .filter(Link.version_id == self.version_id, tuple_(*columns).in_(keys[i:i+self.batchsize])) \
+                    .order_by(Link.branch_id, Link.id):
+                self.links.setdefault((link.from_stop_id, link.from_point_id, link.to_stop_id, link.to_point_id), link)
+        for key in keys:
+            if self.links.setdefault(key, None) is None:
+                self.missing.add(key)
+
+    def get(self, key: LinkKey) -> Optional[Link]:
+        """`Link` for a key (fetched if necessary), `None` if there is none"""
+        if key not in self.links:
+            self.fetch((key,))
+        return self.links[key]
+
+    def course_links(self, course: Course) -> List[Optional[Link]]:
+        """`Link`s between consecutive stops of `course`, `None` where missing"""
+        keys = self.course_keys(course)
+        self.fetch(keys)
+        return [self.links[key] for key in keys]
+
+    def __repr__(self) -> str:
+        return f"<LinkLookup(version_id={self.version_id}, links={len(self.links) - len(self.missing)}, missing={len(self.missing)})>"
+
+
+class LinkGeometryStore:
+    """
+    Coordinates of all `Link`s of a `DINO2.model.Version`, parsed once into one contiguous array
+
+    Points of a link are its `Link.geometry`, else its `Link.force_points`, like in `Link.wkt`.
+    The points of the link `link_ids[i]` are `xy[offsets[i]:offsets[i+1]]`.
+    WKT keeps the coordinates as written in the dataset (like `Link.wkt`), WKB is written as little endian doubles.
+    """
+    def __init__(self, version_id: int, link_ids: ndarray, offsets: ndarray, xy: ndarray, text: ndarray):
+        self.version_id = version_id
+        """Version id"""
+        self.link_ids = link_ids
+        """Sorted link ids"""
+        self.offsets = offsets
+        """Index of the first point of each link in `xy`, and the number of points at the end"""
+        self.xy = xy
+        """X and Y coordinates (WGS84) of all points"""
+        self.text = text
+        """Source coordinates "X Y" of all points, for WKT"""
+
+    @classmethod
+    def for_version(cls, session, version_id: int) -> LinkGeometryStore:
+        """Read and parse the coordinates of all links of a version with one query per point class"""
+        def points(point_cls: Type[LinkPoint]) -> DataFrame:
+            return DataFrame(
+                session.query(point_cls.link_id, point_cls.pos_x, point_cls.pos_y).filter(point_cls.version_id == version_id)
+                .order_by(point_cls.link_id, point_cls.consec_pt_nr).all(),
+                columns=["link_id", "x", "y"])
+        geometry = points(LinkGeometryPoint)
+        force_points = points(LinkForcePoint)
+        data = concat([geometry, force_points[~force_points.link_id.isin(geometry.link_id)]]).sort_values("link_id", kind="stable")
+        link_ids, counts = unique(data.link_id.to_numpy(dtype=int), return_counts=True)
+        xy = ascontiguousarray(data[["x", "y"]].apply(to_numeric).to_numpy(dtype="<f8").reshape(-1, 2))
+        text = (data.x + " " + data.y).to_numpy(dtype=object)
+        return cls(version_id, link_ids, concatenate(([0], cumsum(counts))).astype(int), xy, text)
+
+    def _slice(self, link_id: int) -> slice:
+        i = int(searchsorted(self.link_ids, link_id))
+        if i == len(self.link_ids) or self.link_ids[i] != link_id:
+            return slice(0, 0)
+        return slice(self.offsets[i], self.offsets[i+1])
+
+    def points(self, link_id: int) -> ndarray:
+        """Coordinates of a link as (n, 2) view into `xy`, empty for unknown links"""
+        return self.xy[self._slice(link_id)]
+
+    def _wkt_points(self, link_id: int) -> str:
+        return ", ".join(self.text[self._slice(link_id)])
+
+    def wkt(self, link_id: int) -> str:
+        """WKT LINESTRING of a link"""
+        text = self._wkt_points(link_id)
+        return f"LINESTRING ({text})" if text else "LINESTRING EMPTY"
+
+    def multi_wkt(self, link_ids: Iterable[int]) -> str:
+        """WKT MULTILINESTRING of links, e. g. of all segments of a `DINO2.model.network.Course`"""
+        parts = [f"({text})" for text in map(self._wkt_points, link_ids) if text]
+        return f"MULTILINESTRING ({', '.join(parts)})" if parts else "MULTILINESTRING EMPTY"
+
+    def multi_wkt_m(self, segments: Iterable[Tuple[int, int, int]]) -> str:
+        """
+        WKT MULTILINESTRING M of (link id, start timestamp, end timestamp) segments,
+        with measures interpolated by point index like in `Link.wkt_m`
+        """
+        parts = []
+        for link_id, ts_start, ts_end in segments:
+            text = self.text[self._slice(link_id)]
+            if len(text):
+                parts.append("(" + ", ".join(f"{t} {int(ts_start + i * (ts_end - ts_start) / max(len(text) - 1, 1))}" for i, t in enumerate(text)) + ")")
+        return f"MULTILINESTRING M ({', '.join(parts)})" if parts else "MULTILINESTRING M EMPTY"
+
+    @staticmethod
+    def _wkb_linestring(xy: ndarray) -> bytes:
+        return pack("<BII", 1, 2, len(xy)) + xy.tobytes()
+
+    def wkb(self, link_id: int) -> bytes:
+        """WKB LineString of a link"""
+        return self._wkb_linestring(self.points(link_id))
+
+    def multi_wkb(self, link_ids: Iterable[int]) -> bytes:
+        """WKB MultiLineString of links, leaving out links without points like `multi_wkt`"""
+        parts = [self._wkb_linestring(xy) for xy in map(self.points, link_ids) if len(xy)]
+        return pack("<BII", 1, 5, len(parts)) + b"".join(parts)
+
+    def coordinates(self, link_id: int) -> List[List[float]]:
+        """GeoJSON LineString coordinates of a link"""
+        return self.points(link_id).tolist()
+
+    def __len__(self) -> int:
+        return len(self.link_ids)
+
+    def __repr__(self) -> str:
+        return f"<LinkGeometryStore(version_id={self.version_id}, links={len(self.link_ids)}, points={len(self.xy)})>"
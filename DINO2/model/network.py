@@ -3,14 +3,17 @@
 
 from __future__ import annotations
 
+from dataclasses import dataclass
 from datetime import timedelta, date
 from enum import Enum
 from sqlalchemy import Column, String, Integer, Boolean, ForeignKey, ForeignKeyConstraint, CheckConstraint, and_, case, select, func
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
-from sqlalchemy.orm import relationship, RelationshipProperty, joinedload
+from sqlalchemy.orm import relationship, RelationshipProperty
 from sqlalchemy.sql import ClauseElement
+from numpy import array, count_nonzero, isnan, nanmax, ndarray
+from pandas import DataFrame, to_timedelta
 from time import mktime
-from typing import Optional, Sequence, TYPE_CHECKING
+from typing import Optional, Sequence, Tuple, Dict, Iterator, Mapping, TYPE_CHECKING
 
 from ..types import DinoDate, DinoTimeDelta, IntEnum
 from . import Base, Version
@@ -129,43 +132,40 @@ class Course(Base):
 
     @property
     def wkt(self) -> str:
-        """Get WKT (well known text) representation of course"""
-        text = "MULTILINESTRING ("
-        from .location import Link
-        for (s_f, s_t) in zip(self.stops, self.stops[1:]):
-            link = self._session.query(Link).options(joinedload('geometry')).filter(and_(Link.from_point == s_f.stop_point, Link.to_point == s_t.stop_point)).one()
-            # ...? falls link nicht gefunden.
-            text += f"{link.wkt[11:]}, "
-        return text[:-2] + ")"
+        """Get WKT (well known text) representation of course from `DINO2.model.Version.link_geometry`, without missing segments"""
+        return self.version.link_geometry.multi_wkt(link.id for link in self.version.link_lookup.course_links(self) if link is not None)
+
+    @property
+    def wkb(self) -> bytes:
+        """Get WKB (well known binary) MultiLineString of course from `DINO2.model.Version.link_geometry`, without missing segments"""
+        return self.version.link_geometry.multi_wkb(link.id for link in self.version.link_lookup.course_links(self) if link is not None)
 
     def wkt_m(self, timing_group: int, start_timedelta: Optional[timedelta] = None, start_day: Optional[date] = None) -> str:
-        """Get WKT (well known text) representation with time measures for a timing group, optionally with specific start time&day"""
-        text = "MULTILINESTRING M ("
-        timings = tuple(filter(lambda t: t.timing_group == timing_group, self.stop_timings))
-        assert len(timings) == len(self.stops)
-        currenttime = start_timedelta or timedelta()
-
-        def ts(td: timedelta) -> int:
-            return (int(mktime(start_day.timetuple())) if start_day is not None else 0) + int(td.total_seconds())
-
-        from .location import Link
-        for from_timing, to_timing, s_f, s_t in zip(timings, timings[1:], self.stops, self.stops[1:]):
-            # todo: time_to_stop None..
-            currenttime += from_timing.time_to_stop + from_timing.stopping_time
-            link = self._session.query(Link).options(joinedload('geometry')).filter(and_(Link.from_point == s_f.stop_point, Link.to_point == s_t.stop_point)).one()
-            # ...? falls link nicht gefunden.
-            text += f"{link.wkt_m(ts(currenttime), ts(currenttime + to_timing.time_to_stop))[13:]}, "
-        return text[:-2] + ")"
+        """
+        Get WKT (well known text) representation with time measures for a timing group, optionally with specific start time&day,
+        from `DINO2.model.Version.link_geometry`, without missing segments
+        """
+        pattern = self.stop_time_pattern(timing_group)
+        assert len(pattern) == len(self.stops)
+        arrival, departure = pattern.times(start_timedelta or timedelta())
+
+        def ts(seconds: float) -> int:
+            return (int(mktime(start_day.timetuple())) if start_day is not None else 0) + int(seconds)
+
+        # todo: time_to_stop None..
+        return self.version.link_geometry.multi_wkt_m(
+            (link.id, ts(departure[i]), ts(arrival[i+1]))
+            for i, link in enumerate(self.version.link_lookup.course_links(self)) if link is not None)
+
+    def stop_time_pattern(self, timing_group: int) -> StopTimePattern:
+        """`StopTimePattern` of a timing group, from `DINO2.model.Version.stop_time_patterns`"""
+        key = (self.version_id, self.line, self.id, self.line_dir, timing_group)
+        return self.version.stop_time_patterns.get(key) or StopTimePattern.empty(key)
 
     @hybrid_method
     def duration(self, timing_group: int) -> timedelta:
         """Get duration of whole course for a specific timing group"""
-        return sum(
-            (
-                (s.time_to_stop + s.stopping_time)
-                for s in self.stop_timings
-                if s.timing_group == timing_group and s.time_to_stop is not None
-            ), timedelta())
+        return self.stop_time_pattern(timing_group).duration
 
     @duration.expression
     def duration(cls, timing_group: int) -> ClauseElement:
@@ -329,3 +329,96 @@ class CourseStopTiming(Base):
         return f"<CourseStopTiming(version_id={self.version_id}, course_stop={self.course_stop}, time_to_stop={self.time_to_stop}, stopping_time={self.stopping_time})>"
 
     __abstract__ = False
+
+
+PatternKey = Tuple[int, int, str, int, int]
+"""(version id, line, course id, line direction, timing group) of a `StopTimePattern`"""
+
+
+@dataclass(frozen=True, eq=False)
+class StopTimePattern:
+    """
+    Stop times of all trips of a `Course` with the same timing group, relative to their departure time
+
+    One element per `CourseStopTiming`, ordered by `CourseStopTiming.consec_stop_nr`.
+    Offsets and distances are NaN where `DINO2.model.schedule.Trip.trip_stops` has `None` (passing through, no length yet).
+    Patterns are compared and hashed by identity, as their arrays can't be.
+    """
+    key: PatternKey
+    consec_stop_nr: ndarray
+    """Consecutive stop numbers"""
+    stop_id: ndarray
+    """`CourseStop.stop_id`s (-1 without `CourseStop`)"""
+    stop_point_id: ndarray
+    """`CourseStop.stop_point_id`s (-1 without `CourseStop`)"""
+    arrival: ndarray
+    """Arrival offsets in seconds"""
+    departure: ndarray
+    """Departure offsets in seconds"""
+    distance: ndarray
+    """Distance travelled in m"""
+
+    @classmethod
+    def empty(cls, key: PatternKey) -> StopTimePattern:
+        """Pattern without stops, for courses or timing groups without `CourseStopTiming`s"""
+        return cls(key, *(array([], dtype=int) for _ in range(3)), *(array([], dtype=float) for _ in range(3)))
+
+    @property
+    def duration(self) -> timedelta:
+        """Duration of the whole course, like `Course.duration`"""
+        return timedelta(seconds=float(nanmax(self.departure))) if count_nonzero(~isnan(self.departure)) else timedelta()
+
+    def times(self, departure_time: timedelta) -> Tuple[ndarray, ndarray]:
+        """Arrival and departure times in seconds after midnight for a trip departing at `departure_time`"""
+        start = departure_time.total_seconds()
+        return self.arrival + start, self.departure + start
+
+    def __len__(self) -> int:
+        return len(self.consec_stop_nr)
+
+
+class StopTimePatterns(Mapping[PatternKey, StopTimePattern]):
+    """
+    All `StopTimePattern`s of a `DINO2.model.Version`, by `PatternKey`
+
+    Built by `StopTimePatterns.for_version` with one query and cumulative sums over contiguous arrays,
+    each pattern holds views into them.
+    """
+    def __init__(self, patterns: Dict[PatternKey, StopTimePattern]):
+        self._patterns = patterns
+
+    @classmethod
+    def for_version(cls, session, version_id: int) -> StopTimePatterns:
+        """Compute the stop time patterns of all courses of a version"""
+        keys = ["line", "course", "line_dir", "timing_group"]
+        data = DataFrame(
+            session.query(
+                CourseStopTiming.line, CourseStopTiming.course_id, CourseStopTiming.line_dir, CourseStopTiming.timing_group,
+                CourseStopTiming.consec_stop_nr, CourseStop.stop_id, CourseStop.stop_point_id, CourseStopTiming.time_to_stop, CourseStopTiming.stopping_time, CourseStop.length)
+            .outerjoin(CourseStopTiming.course_stop)
+            .filter(CourseStopTiming.version_id == version_id)
+            .order_by(*(getattr(CourseStopTiming, c) for c in ("line", "course_id", "line_dir", "timing_group", "consec_stop_nr"))).all(),
+            columns=[*keys, "consec_stop_nr", "stop_id", "stop_point_id", "time_to_stop", "stopping_time", "length"])
+        time_to_stop = to_timedelta(data.time_to_stop).dt.total_seconds()
+        stopping_time = to_timedelta(data.stopping_time).dt.total_seconds()
+        groups = data.groupby(keys, sort=False)
+        departure = (time_to_stop + stopping_time).fillna(0).groupby(groups.ngroup()).cumsum().where(time_to_stop.notna())
+        length = data.length.astype(float)
+        distance = length.fillna(0).groupby(groups.ngroup()).cumsum().where(length.notna().groupby(groups.ngroup()).cummax())
+        arrays = (
+            *(data[c].fillna(-1).to_numpy(dtype=int) for c in ("consec_stop_nr", "stop_id", "stop_point_id")),
+            (departure - stopping_time).to_numpy(dtype=float), departure.to_numpy(dtype=float), distance.to_numpy(dtype=float))
+        patterns = {}
+        for key, index in groups.indices.items():
+            s = slice(index[0], index[-1] + 1)
+            patterns[(version_id, *key)] = StopTimePattern((version_id, *key), *(a[s] for a in arrays))
+        return cls(patterns)
+
+    def __getitem__(self, key: PatternKey) -> StopTimePattern:
+        return self._patterns[key]
+
+    def __iter__(self) -> Iterator[PatternKey]:
+        return iter(self._patterns)
+
+    def __len__(self) -> int:
+        return len(self._patterns)
@@ -3,21 +3,25 @@
 
 from __future__ import annotations
 
+from collections import defaultdict
 from dataclasses import dataclass
 from datetime import date, timedelta
 from enum import Enum
-from sqlalchemy import Column, String, Integer, Boolean, ForeignKey, ForeignKeyConstraint, CheckConstraint, and_, or_, tuple_
+from sqlalchemy import Column, String, Integer, Boolean, ForeignKey, ForeignKeyConstraint, CheckConstraint, and_, or_, tuple_, inspect
 from sqlalchemy.orm import relationship, RelationshipProperty, joinedload, Query
-from typing import Optional, Tuple, FrozenSet, Sequence, TYPE_CHECKING
+from sqlalchemy.sql import ClauseElement
+from numpy import arange, argsort, array, flatnonzero, ndarray, ones, packbits, unique, unpackbits, zeros
+from pandas import DataFrame, Series, notna
+from typing import Optional, Tuple, FrozenSet, Sequence, List, Dict, Set, Iterable, Iterator, Union, TYPE_CHECKING
 
 from ..types import DinoTimeDelta, IntEnum, CharEnum
-from . import Base, Version
+from . import Base, Version, session_cached
 
 if TYPE_CHECKING:
-    from .calendar import DayAttribute, Restriction
+    from .calendar import DayAttribute, DayBitset, Restriction
     from .location import Stop, StopPoint
     from .operational import Operator, OperatorBranchOffice, VehicleType, VehicleDestinationText
-    from .network import Course, CourseStop, CourseStopTiming
+    from .network import Course, CourseStop, CourseStopTiming, StopTimePattern
 
 
 class NoticeContentType(Enum):
@@ -94,6 +98,22 @@ class TripStop:
         return f"<TripStop(trip={self.trip}, stop_timing={self.stop_timing}, arr_time={self.arr_time}, dep_time={self.dep_time})>"
 
 
+def _first_per_stop(changes: Iterable[TripVDT]) -> Dict[int, TripVDT]:
+    """First vdt change per `consec_stop_nr`"""
+    first: Dict[int, TripVDT] = {}
+    for change in changes:
+        first.setdefault(change.consec_stop_nr, change)
+    return first
+
+
+def _all_per_stop(constraints: Iterable[StopConstraint]) -> Dict[int, FrozenSet[StopConstraint]]:
+    """Constraints per `consec_stop_nr`"""
+    per_stop: Dict[int, Set[StopConstraint]] = defaultdict(set)
+    for constraint in constraints:
+        per_stop[constraint.consec_stop_nr].add(constraint)
+    return {nr: frozenset(c) for nr, c in per_stop.items()}
+
+
 class Trip(Base):
     """
     Trip
@@ -251,11 +271,18 @@ class Trip(Base):
 
     def trip_stops(self, simple: bool = False) -> Tuple[TripStop, ...]:
         """All trip stops as `TripStop` objects"""
+        if simple:
+            return self._trip_stops(self.stop_timings, None, None)
+        return self._trip_stops(self.stop_timings, _first_per_stop(self.vdt_changes), _all_per_stop(self.constraints))
+
+    def _trip_stops(self, timings: Sequence[CourseStopTiming], vdt_changes: Optional[Dict[int, TripVDT]], constraints: Optional[Dict[int, FrozenSet[StopConstraint]]]) -> Tuple[TripStop, ...]:
+        """`TripStop`s from `timings` and vdt changes and constraints by `consec_stop_nr` (both `None` if simple)"""
+        simple = vdt_changes is None
         tstops = []
         currenttime = self.departure_time
         current_Tvdt: Optional[TripVDT] = None
         d_t: Optional[int] = None
-        for timing in self.stop_timings:
+        for timing in timings:
             if timing.time_to_stop is not None:
                 # None: passes through stop
                 currenttime += timing.time_to_stop
@@ -263,7 +290,7 @@ class Trip(Base):
                 d_t = (d_t or 0) + timing.course_stop.length
             prev_Tvdt = current_Tvdt
             if not simple:
-                current_Tvdt = next(filter(lambda c: c.consec_stop_nr == timing.consec_stop_nr, self.vdt_changes), None) or prev_Tvdt
+                current_Tvdt = vdt_changes.get(timing.consec_stop_nr) or prev_Tvdt
             tstops.append(
                 TripStop(
                     trip=self,
@@ -271,7 +298,7 @@ class Trip(Base):
                     stop_point=timing.course_stop.stop_point,
                     course_stop=timing.course_stop,
                     stop_timing=timing,
-                    constraints=frozenset(filter(lambda c: c.consec_stop_nr == timing.consec_stop_nr, self.constraints)) if not simple else None,
+                    constraints=constraints.get(timing.consec_stop_nr, frozenset()) if not simple else None,
                     vdt_before=prev_Tvdt.vdt if prev_Tvdt else None,
                     vdt_after=current_Tvdt.vdt if current_Tvdt else None,
                     arr_time=None if timing.time_to_stop is None else currenttime,
@@ -282,6 +309,61 @@ class Trip(Base):
                 currenttime += timing.stopping_time
         return tuple(tstops)
 
+    @staticmethod
+    def trip_stops_for(trips: Iterable[Trip], simple: bool = False, batchsize: int = 500) -> Dict[Trip, Tuple[TripStop, ...]]:
+        """
+        `Trip.trip_stops` of many trips (of one session) at once
+
+        Stop timings (with course stops, stops and stop points), vdt changes and constraints are loaded
+        with one query per `batchsize` trips each, stop timings only once per distinct timing group of a course.
+        """
+        from .network import CourseStopTiming
+        trips = list(trips)
+        if not trips:
+            return {}
+        session = trips[0]._session
+
+        def load(query: Query, columns: Tuple, keys: Sequence[Tuple]) -> List:
+            return [o for i in range(0, len(keys), batchsize) for o in query.filter(tuple_(*columns).in_(keys[i:i+batchsize])).all()]
+        timing_keys = sorted(set((t.version_id, t.line, t.course_id, t.line_dir, t.timing_group) for t in trips))
+        timings: Dict[Tuple, List[CourseStopTiming]] = defaultdict(list)
+        for timing in load(
+                session.query(CourseStopTiming)
+                .options(joinedload('course_stop').joinedload('stop'), joinedload('course_stop').joinedload('stop_point'))
+                .order_by(CourseStopTiming.consec_stop_nr.asc()),
+                (CourseStopTiming.version_id, CourseStopTiming.line, CourseStopTiming.course_id, CourseStopTiming.line_dir, CourseStopTiming.timing_group),
+                timing_keys):
+            timings[(timing.version_id, timing.line, timing.course_id, timing.line_dir, timing.timing_group)].append(timing)
+        if simple:
+            return {t: t._trip_stops(timings[(t.version_id, t.line, t.course_id, t.line_dir, t.timing_group)], None, None) for t in trips}
+
+        trip_keys = sorted(set((t.version_id, t.line, t.id) for t in trips))
+        vdt_changes: Dict[Tuple[int, int, int], List[TripVDT]] = defaultdict(list)
+        for change in load(
+                session.query(TripVDT).options(joinedload('vdt')).order_by(TripVDT.consec_stop_nr.asc()),
+                (TripVDT.version_id, TripVDT.line, TripVDT.trip_id), trip_keys):
+            vdt_changes[(change.version_id, change.line, change.trip_id)].append(change)
+        constraints: Dict[Tuple[int, int, int], List[StopConstraint]] = defaultdict(list)
+        for constraint in load(session.query(StopConstraint), (StopConstraint.version_id, StopConstraint.line, StopConstraint.trip_id), trip_keys):
+            constraints[(constraint.version_id, constraint.line, constraint.trip_id)].append(constraint)
+        return {
+            t: t._trip_stops(
+                timings[(t.version_id, t.line, t.course_id, t.line_dir, t.timing_group)],
+                _first_per_stop(vdt_changes[(t.version_id, t.line, t.id)]),
+                _all_per_stop(constraints[(t.version_id, t.line, t.id)]))
+            for t in trips}
+
+    @property
+    def stop_time_pattern(self) -> StopTimePattern:
+        """`DINO2.model.network.StopTimePattern` of this trip's course and timing group, from `DINO2.model.Version.stop_time_patterns`"""
+        from .network import StopTimePattern
+        key = (self.version_id, self.line, self.course_id, self.line_dir, self.timing_group)
+        return self.version.stop_time_patterns.get(key) or StopTimePattern.empty(key)
+
+    def stop_times(self) -> Tuple[ndarray, ndarray]:
+        """Arrival and departure times of all trip stops in seconds after midnight (NaN if passing through), like `Trip.trip_stops`"""
+        return self.stop_time_pattern.times(self.departure_time)
+
     def wkt(self, day: Optional[date] = None) -> str:
         """Get WKT (well known text) representation with time measures of this trip"""
         return self.course.wkt_m(self.timing_group, self.departure_time, day)
@@ -294,20 +376,78 @@ class Trip(Base):
     @property
     def dates(self) -> FrozenSet[date]:
         """Valid dates"""
-        ds = self.day_attribute.dates if self.restriction is None else (self.day_attribute.dates & self.restriction.dates)
+        ds = self.day_attribute.bitset if self.restriction is None else (self.day_attribute.bitset & self.restriction.bitset)
         return frozenset(filter(self.course.date_valid, ds))
 
     @staticmethod
-    def query_for_date(session, date_obj: date) -> Query:
-        """Query for all trips valid on a specific `datetime.date`. Does not check for `DINO2.model.Version.priority`!"""
-        from .calendar import Restriction, DayAttribute, CalendarDay
+    def query_for_date(session, date_obj: date, resolve_priority: bool = False) -> Query:
+        """
+        Query for all trips valid on a specific `datetime.date`.
+        Only checks for `DINO2.model.Version.priority` if `resolve_priority`, using `DINO2.model.calendar.VersionCalendar`!
+
+        Restrictions are checked in SQL using `DINO2.model.calendar.RestrictionDay`s for versions where they were materialized on import
+        (looked up once per session until its next flush, commit or rollback, see `DINO2.model.session_cached`), else decoded here. Like `Trip.restriction`, a `DINO2.model.calendar.Restriction` only applies to a trip if it is for the trip's line or for all lines,
+        one for the trip's line taking precedence (as in `ServiceDays`); trips without applicable restriction are unrestricted.
+        """
+        from .calendar import Restriction, RestrictionDay, DayAttribute, CalendarDay, VersionCalendar
         from .network import Course
-        restrictions = set((r.version_id, r.id) for r in session.query(Restriction).all() if date_obj in r.dates)
-        # todo: ist Restriction.line zu beachten?
+        def materialized_versions() -> FrozenSet[int]:
+            if not inspect(session.get_bind()).has_table(RestrictionDay.__tablename__):
+                return frozenset()
+            return frozenset(v for (v,) in session.query(RestrictionDay.version_id).distinct())
+        materialized = session_cached(session, "restriction_day_versions", materialized_versions)
+        decoded = [r for r in session.query(Restriction).filter(Restriction.version_id.notin_(materialized)) if date_obj in r.bitset]
+
+        def restriction(line_specific: bool) -> ClauseElement:
+            return session.query(Restriction).filter(
+                Restriction.version_id == Trip.version_id, Restriction.id == Trip.restriction_id,
+                (Restriction.line == Trip.line) if line_specific else (Restriction.line == None)).exists()
+
+        def active(line_specific: bool) -> ClauseElement:
+            if line_specific:
+                clauses = [tuple_(Trip.version_id, Trip.restriction_id, Trip.line).in_([(r.version_id, r.id, r.line) for r in decoded if r.line is not None])]
+            else:
+                clauses = [tuple_(Trip.version_id, Trip.restriction_id).in_([(r.version_id, r.id) for r in decoded if r.line is None])]
+            if materialized:
+                clauses.append(session.query(RestrictionDay).filter(
+                    RestrictionDay.version_id == Trip.version_id, RestrictionDay.restriction_id == Trip.restriction_id,
+                    (RestrictionDay.line == Trip.line) if line_specific else (RestrictionDay.line == None), RestrictionDay.day == date_obj).exists())
+            return or_(*clauses)
+        restriction_valid = or_(
+            Trip.restriction_id == None,
+            and_(restriction(True), active(True)),
+            and_(~restriction(True), or_(~restriction(False), active(False))))
         attrs = session.query(DayAttribute).join('days').filter(CalendarDay.day == date_obj).subquery()
-        return session.query(Trip).options(joinedload('course', innerjoin=True)).join(attrs) \
+        q = session.query(Trip).options(joinedload('course', innerjoin=True)).join(attrs) \
             .filter(Trip.course.has(criterion=Course.date_valid(date_obj))) \
-            .filter((Trip.restriction_id == None) | (tuple_(Trip.version_id, Trip.restriction_id).in_(restrictions)))
+            .filter(restriction_valid)
+        if resolve_priority:
+            q = q.filter(Trip.version_id.in_(VersionCalendar.for_session(session).versions_for(date_obj)))
+        return q
+
+    @staticmethod
+    def query_for_dates(session, date_from: date, date_to: date, query: Optional[Query] = None, resolve_priority: bool = False) -> Iterator[Tuple[date, List[Trip]]]:
+        """
+        Trips valid on each day from `date_from` until `date_to` (inclusive), as (date, trips) in order of date, like `Trip.query_for_date`.
+
+        Trips are loaded with a single `query` (default: all trips; filters and loader options may be added),
+        days are looked up in `DINO2.model.Version.service_days`. Lists of trips are built once per `ServiceDayClass`
+        and generated one date at a time, so long ranges do not have to be held in memory.
+        If `resolve_priority`, only trips of the effective version per date and net are included (see `DINO2.model.calendar.VersionCalendar`).
+        """
+        from .calendar import VersionCalendar
+        trips = (query if query is not None else session.query(Trip)).all()
+        by_key = {(t.version_id, t.line, t.id): t for t in trips}
+        per_date: Dict[date, List[List[Trip]]] = defaultdict(list)
+        for version in session.query(Version).filter(Version.id.in_(set(t.version_id for t in trips))):
+            for dc in version.service_days.day_classes(date_from, date_to):
+                class_trips = [by_key[k] for k in ((version.id, *key) for key in dc.trips) if k in by_key]
+                for d in dc.dates:
+                    if not resolve_priority or VersionCalendar.for_session(session).version_for(d, version.net) == version.id:
+                        per_date[d].append(class_trips)
+        for n in range((date_to - date_from).days + 1):
+            day = date_from + timedelta(days=n)
+            yield day, [t for class_trips in per_date.pop(day, ()) for t in class_trips]
 
     def __repr__(self) -> str:
         return f"<Trip(version_id={self.version_id}, line={self.line}, id={self.id}, departure_time={self.departure_time}, day_attribute={self.day_attribute}, restriction_id={self.restriction_id})>"
@@ -315,6 +455,139 @@ class Trip(Base):
     __abstract__ = False
 
 
+@dataclass(frozen=True)
+class ServiceDayClass:
+    """Dates of a `DINO2.model.Version` with identical sets of running trips"""
+    dates: Tuple[date, ...]
+    trips: Tuple[Tuple[int, int], ...]
+
+    def __repr__(self) -> str:
+        return f"<ServiceDayClass(dates={len(self.dates)}, first={self.dates[0] if self.dates else None}, trips={len(self.trips)})>"
+
+
+class ServiceDays:
+    """
+    Service days of all `Trip`s of a `DINO2.model.Version`, as a packed bit matrix with one row per trip and one column per day of the version's calendar
+
+    Built by `ServiceDays.for_version` in one vectorized pass over day attributes, restrictions and course validity periods,
+    with the same result as `Trip.dates`. Day checks and day counts of a trip take constant time.  
+    Trips are identified by `Trip` objects or (`Trip.line`, `Trip.id`) tuples.
+    """
+    def __init__(self, version_id: int, start: int, keys: Sequence[Tuple[int, int]], bits: ndarray):
+        self.version_id = version_id
+        """Version id"""
+        self.start = start
+        """Ordinal of the first day (see `datetime.date.toordinal`)"""
+        self.days = bits.shape[1]
+        """Number of days"""
+        self.keys = tuple(keys)
+        """(`Trip.line`, `Trip.id`) of each row"""
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        """Row of each key"""
+        self.packed = packbits(bits, axis=1)
+        """Service days, 8 per byte"""
+        self.counts = bits.sum(axis=1)
+        """Number of service days of each row"""
+
+    @classmethod
+    def for_version(cls, session, version_id: int) -> ServiceDays:
+        """Compute the service days of all trips of a version"""
+        from .calendar import CalendarDay, DayGrouping, Restriction, DayBitset
+        from .network import Course
+        version = session.query(Version).get(version_id)
+        calendar_days = DataFrame(
+            session.query(CalendarDay.day, DayGrouping.dayattr_id)
+            .join(DayGrouping, and_(DayGrouping.version_id == CalendarDay.version_id, DayGrouping.daytype_id == CalendarDay.daytype_id))
+            .filter(CalendarDay.version_id == version_id).all(),
+            columns=["day", "attr"])
+        trips = DataFrame(
+            session.query(Trip.line, Trip.id, Trip.day_attribute_id, Trip.restriction_id, Trip.course_id, Trip.line_dir)
+            .filter(Trip.version_id == version_id).order_by(Trip.line, Trip.id).all(),
+            columns=["line", "id", "attr", "restriction", "course", "line_dir"])
+        courses = DataFrame(
+            session.query(Course.line, Course.id, Course.line_dir, Course.valid_from, Course.valid_to).filter(Course.version_id == version_id).all(),
+            columns=["line", "course", "line_dir", "valid_from", "valid_to"])
+        restrictions = session.query(Restriction.id, Restriction.line, Restriction.daystring, Restriction.date_from, Restriction.date_until) \
+            .filter(Restriction.version_id == version_id).all()
+
+        ordinals = calendar_days.day.map(date.toordinal).to_numpy(dtype=int)
+        start = int(ordinals.min()) if len(ordinals) else 0
+        n = int(ordinals.max()) - start + 1 if len(ordinals) else 0
+        # day attributes x days, plus an empty row for trips with an unknown day attribute
+        attrs = {a: i for i, a in enumerate(calendar_days.attr.unique())}
+        attr_days = zeros((len(attrs) + 1, n), dtype=bool)
+        attr_days[calendar_days.attr.map(attrs).to_numpy(dtype=int), ordinals - start] = True
+        attr_rows = trips.attr.map(attrs).fillna(len(attrs)).to_numpy(dtype=int)
+        # restrictions x days, plus a full row for trips without (matching) restriction
+        restriction_days = ones((len(restrictions) + 1, n), dtype=bool)
+        for i, r in enumerate(restrictions):
+            restriction_days[i] = DayBitset.from_daystring(r.daystring, r.date_from, r.date_until).window(start, start + n)
+        rows = DataFrame([(r.id, r.line, i) for i, r in enumerate(restrictions)], columns=["restriction", "line", "row"])
+        line_rows = trips.merge(rows.dropna(subset=["line"]).astype({"line": "int64"}), how="left", on=["restriction", "line"]).row
+        generic_rows = trips[["restriction"]].merge(rows[rows.line.isna()].drop(columns="line"), how="left", on="restriction").row
+        restriction_rows = line_rows.fillna(generic_rows).fillna(len(restrictions)).to_numpy(dtype=int)
+        # validity periods of the courses (else of the version), trips without course have no service days
+        course_keys = trips[["line", "course", "line_dir"]].merge(courses, how="left", on=["line", "course", "line_dir"], indicator=True)
+        has_course = (course_keys._merge == "both").to_numpy()
+
+        def offsets(values: Series, default: Optional[date], unbounded: date) -> ndarray:
+            return array([(d if notna(d) else default or unbounded).toordinal() - start for d in values], dtype=int)
+        lo = offsets(course_keys.valid_from, version.date_from if version else None, date.min)
+        hi = offsets(course_keys.valid_to, version.date_to if version else None, date.max)
+        day = arange(n)
+        valid = (day >= lo[:, None]) & (day <= hi[:, None]) & has_course[:, None]
+
+        bits = attr_days[attr_rows] & restriction_days[restriction_rows] & valid
+        return cls(version_id, start, list(zip(trips.line.tolist(), trips.id.tolist())), bits)
+
+    def _row(self, trip: Union[Trip, Tuple[int, int]]) -> int:
+        return self.index[(trip.line, trip.id) if isinstance(trip, Trip) else trip]
+
+    def runs_on(self, trip: Union[Trip, Tuple[int, int]], day: date) -> bool:
+        """Whether `trip` runs on `day`"""
+        d = day.toordinal() - self.start
+        return 0 <= d < self.days and bool(self.packed[self._row(trip), d >> 3] & (0x80 >> (d & 7)))
+
+    def count(self, trip: Union[Trip, Tuple[int, int]]) -> int:
+        """Number of service days of `trip`"""
+        return int(self.counts[self._row(trip)])
+
+    def bitset(self, trip: Union[Trip, Tuple[int, int]]) -> DayBitset:
+        """Service days of `trip` as `DINO2.model.calendar.DayBitset`"""
+        from .calendar import DayBitset
+        return DayBitset(self.start, unpackbits(self.packed[self._row(trip)], count=self.days).astype(bool))
+
+    def trips_on(self, day: date) -> List[Tuple[int, int]]:
+        """Keys of all trips running on `day`"""
+        d = day.toordinal() - self.start
+        if not 0 <= d < self.days:
+            return []
+        return [self.keys[i] for i in flatnonzero(self.packed[:, d >> 3] & (0x80 >> (d & 7)))]
+
+    def day_classes(self, date_from: Optional[date] = None, date_until: Optional[date] = None) -> List[ServiceDayClass]:
+        """
+        Group the days from `date_from` until `date_until` (inclusive, default: all days) into `ServiceDayClass`es,
+        ordered by their first date. Per-date results only have to be computed once per class.
+        """
+        lo = max(date_from.toordinal() - self.start, 0) if date_from is not None else 0
+        hi = min(date_until.toordinal() - self.start + 1, self.days) if date_until is not None else self.days
+        if hi <= lo:
+            return []
+        days = unpackbits(self.packed, axis=1, count=self.days)[:, lo:hi].T
+        columns, first, inverse = unique(days, axis=0, return_index=True, return_inverse=True)
+        return [
+            ServiceDayClass(
+                tuple(date.fromordinal(self.start + lo + d) for d in flatnonzero(inverse.ravel() == c)),
+                tuple(self.keys[i] for i in flatnonzero(columns[c])))
+            for c in argsort(first)]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __repr__(self) -> str:
+        return f"<ServiceDays(version_id={self.version_id}, trips={len(self.keys)}, start={date.fromordinal(self.start) if self.days else None}, days={self.days})>"
+
+
 class StopConstraintType(Enum):
     only_alighting = 'A'
     only_boarding = 'E'
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar timetable of a `DINO2.model.Version` for vectorized analyses
+
+All trips, their `DINO2.model.network.StopTimePattern`s and stop events (one per trip stop) are held in NumPy arrays,
+read with a few bulk queries instead of walking `DINO2.model.schedule.Trip` → `stop_timings` → `course_stop` → `stop`.
+"""
+
+from __future__ import annotations
+
+from datetime import date
+from numpy import arange, argsort, array, concatenate, cumsum, diff, flatnonzero, isnan, nan_to_num, ndarray, repeat, searchsorted, unique, zeros
+from sqlalchemy.orm.session import Session
+from typing import Iterable, Optional, Sequence, Tuple
+
+from .model import Version
+from .model.network import PatternKey, StopTimePattern
+from .model.schedule import ServiceDays, Trip
+
+
+def _where_pattern(values: ndarray, trip_pattern: ndarray, default) -> ndarray:
+    """`values` of each trip's pattern, `default` for trips without pattern"""
+    result = values[trip_pattern] if len(values) else zeros(len(trip_pattern), dtype=values.dtype)
+    result[trip_pattern < 0] = default
+    return result
+
+
+class Timetable:
+    """
+    Trips, stop time patterns and stop events of a `DINO2.model.Version` as arrays
+
+    Trips are indexed in order of (`DINO2.model.schedule.Trip.line`, `DINO2.model.schedule.Trip.id`), like in `DINO2.model.schedule.ServiceDays`.
+    Stop events (trip stops) are grouped by trip, see `trip_events`.
+    Times are seconds after midnight of the operating day, NaN where the trip passes through.
+    Methods with a `trips` parameter take a boolean mask over all trips (e. g. `Timetable.trips_on`) to restrict their result.
+    """
+    def __init__(self, version_id: int, patterns: Sequence[StopTimePattern], trip_keys: Sequence[Tuple[int, int]], trip_pattern: ndarray, trip_departure: ndarray, service_days: Optional[ServiceDays] = None):
+        self.version_id = version_id
+        """Version id"""
+        self.service_days = service_days
+        """`DINO2.model.schedule.ServiceDays` of the version, for `Timetable.trips_on`"""
+
+        self.pattern_keys: Tuple[PatternKey, ...] = tuple(p.key for p in patterns)
+        """Key of each pattern"""
+        lengths = array([len(p) for p in patterns], dtype=int)
+        self.pattern_start = concatenate(([0], cumsum(lengths))).astype(int)
+        """Index of the first element of each pattern in the `pattern_*` arrays, and their total length at the end"""
+
+        def pattern_array(attr: str, dtype: type) -> ndarray:
+            return concatenate([getattr(p, attr) for p in patterns]).astype(dtype) if patterns else array([], dtype=dtype)
+        self.stop_ids, self.pattern_stop = unique(pattern_array("stop_id", int), return_inverse=True)
+        """`DINO2.model.location.Stop.id` of each stop index / stop index of each pattern element"""
+        self.pattern_arrival = pattern_array("arrival", float)
+        """Arrival offset of each pattern element"""
+        self.pattern_departure = pattern_array("departure", float)
+        """Departure offset of each pattern element"""
+        distance = pattern_array("distance", float)
+        self.pattern_length = nan_to_num(distance[self.pattern_start[1:] - 1]) * (lengths > 0) if len(distance) else zeros(len(lengths))
+        """Length of each pattern in m"""
+
+        self.trip_keys: Tuple[Tuple[int, int], ...] = tuple(trip_keys)
+        """(line, id) of each trip"""
+        self.trip_pattern = trip_pattern
+        """Pattern index of each trip (-1 without stop timings)"""
+        self.trip_departure = trip_departure
+        """Departure time of each trip"""
+        has_pattern = trip_pattern >= 0
+        trip_lengths = _where_pattern(lengths, trip_pattern, 0)
+        self.trip_length = _where_pattern(self.pattern_length, trip_pattern, 0.0)
+        """Length of each trip in m"""
+        self.trip_events = concatenate(([0], cumsum(trip_lengths))).astype(int)
+        """Index of the first stop event of each trip, and the number of stop events at the end"""
+
+        self.event_trip = repeat(arange(len(self.trip_keys)), trip_lengths)
+        """Trip index of each stop event"""
+        elements = repeat(self.pattern_start[:-1][trip_pattern[has_pattern]] - self.trip_events[:-1][has_pattern], trip_lengths[has_pattern]) \
+            + arange(self.trip_events[-1])
+        self.event_stop = self.pattern_stop[elements]
+        """Stop index of each stop event"""
+        self.arrival = self.pattern_arrival[elements] + trip_departure[self.event_trip]
+        """Arrival time of each stop event"""
+        self.departure = self.pattern_departure[elements] + trip_departure[self.event_trip]
+        """Departure time of each stop event"""
+        self.event_last = zeros(len(self.event_trip), dtype=bool)
+        """Whether a stop event is the last one of its trip"""
+        self.event_last[self.trip_events[1:][trip_lengths > 0] - 1] = True
+
+    @classmethod
+    def for_version(cls, session: Session, version_id: int) -> Timetable:
+        """Load the timetable of a version, from `DINO2.model.Version.stop_time_patterns` and one query for the trips"""
+        version = session.query(Version).get(version_id)
+        patterns = list(version.stop_time_patterns.values())
+        pattern_index = {p.key: i for i, p in enumerate(patterns)}
+        trips = session.query(Trip.line, Trip.id, Trip.course_id, Trip.line_dir, Trip.timing_group, Trip.departure_time) \
+            .filter(Trip.version_id == version_id).order_by(Trip.line, Trip.id).all()
+        return cls(
+            version_id, patterns,
+            [(t.line, t.id) for t in trips],
+            array([pattern_index.get((version_id, t.line, t.course_id, t.line_dir, t.timing_group), -1) for t in trips], dtype=int),
+            array([t.departure_time.total_seconds() for t in trips], dtype=float),
+            version.service_days)
+
+    def stop_index(self, stop_id: int) -> int:
+        """Stop index of a `DINO2.model.location.Stop.id`, -1 if no trip stops there"""
+        i = int(searchsorted(self.stop_ids, stop_id))
+        return i if i < len(self.stop_ids) and self.stop_ids[i] == stop_id else -1
+
+    def trip_mask(self, keys: Iterable[Tuple[int, int]]) -> ndarray:
+        """Boolean mask over all trips with the given (line, id) keys"""
+        index = {key: i for i, key in enumerate(self.trip_keys)}
+        mask = zeros(len(self.trip_keys), dtype=bool)
+        mask[[index[key] for key in keys if key in index]] = True
+        return mask
+
+    def trips_on(self, day: date) -> ndarray:
+        """Boolean mask over all trips running on `day`"""
+        if self.service_days is None:
+            raise ValueError("Timetable without service days")
+        return self.trip_mask(self.service_days.trips_on(day))
+
+    def departures(self, stop_id: int, trips: Optional[ndarray] = None, start: Optional[float] = None, end: Optional[float] = None) -> ndarray:
+        """Stop events departing from a stop (from `start` until before `end`), ordered by departure time, without the last stops of trips"""
+        selected = (self.event_stop == self.stop_index(stop_id)) & ~self.event_last & ~isnan(self.departure)
+        if trips is not None:
+            selected &= trips[self.event_trip]
+        if start is not None:
+            selected &= self.departure >= start
+        if end is not None:
+            selected &= self.departure < end
+        events = flatnonzero(selected)
+        return events[argsort(self.departure[events], kind="stable")]
+
+    def headways(self, stop_id: int, trips: Optional[ndarray] = None) -> ndarray:
+        """Seconds between consecutive departures from a stop"""
+        return diff(self.departure[self.departures(stop_id, trips)])
+
+    def vehicle_km(self, trips: Optional[ndarray] = None, days: bool = False) -> float:
+        """Total length of all trips in km, multiplied by each trip's number of service days if `days`"""
+        length = self.trip_length if trips is None else self.trip_length * trips
+        if days:
+            if self.service_days is None:
+                raise ValueError("Timetable without service days")
+            length = length * self.service_days.counts[[self.service_days.index[key] for key in self.trip_keys]]
+        return float(length.sum() / 1000)
+
+    def __len__(self) -> int:
+        return len(self.trip_keys)
+
+    def __repr__(self) -> str:
+        return f"<Timetable(version_id={self.version_id}, trips={len(self.trip_keys)}, patterns={len(self.pattern_keys)}, stops={len(self.stop_ids)}, events={len(self.event_trip)})>"
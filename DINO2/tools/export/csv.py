@@ -72,15 +72,22 @@ def courses(session: Session, path: str, line_ids: Optional[Set[int]] = None, ex
                 ) for cs in course.stops])
 
 
-def trips(session: Session, fname: str, date_: date, line_ids: Optional[Set[int]] = None, version_id: Optional[int] = None) -> None:
-    """Export csv file of trips for a given date"""
+def trips(session: Session, fname: str, date_: date, line_ids: Optional[Set[int]] = None, version_id: Optional[int] = None, resolve_priority: bool = False) -> None:
+    """Export csv file of trips for a given date (only of the effective versions by priority if `resolve_priority`)"""
     rows = [("lineid", "linesymbol", "from", "to", "startt", "endt", "tripid", "wkt")]
-    q = schedule.Trip.query_for_date(session, date_)
+    q = schedule.Trip.query_for_date(session, date_, resolve_priority)
     if version_id is not None:
         q = q.filter_by(version_id=version_id)
     if line_ids:
         q = q.filter(schedule.Trip.line.in_(line_ids))
-    for trip in q.all():
+    trips = q.all()
+    for version in sorted(set(trip.version for trip in trips), key=lambda v: v.id):
+        courses = set(trip.course for trip in trips if trip.version_id == version.id)
+        version.link_lookup.prefetch(courses)
+        missing = version.link_lookup.missing.intersection(key for course in courses for key in location.LinkLookup.course_keys(course))
+        if missing:
+            print(f"--> warning: version {version.id}: no link between stop points {', '.join(str(key) for key in sorted(missing, key=str))}")
+    for trip in trips:
         rows.append(
             (
                 trip.line, trip.course.name, trip.dep_stop.name, trip.arr_stop.name,
@@ -96,24 +103,20 @@ def line_stats(session: Session, fname: str, version_id: Optional[int] = None) -
     """Line statistics with total year-kilometers per version->line->course"""
     lq = session.query(schedule.Trip, network.Course.length) \
         .order_by(schedule.Trip.version_id.asc(), schedule.Trip.line.asc(), schedule.Trip.line_dir.asc(), schedule.Trip.course_id.asc()) \
-        .options(
-            joinedload('course', innerjoin=True),
-            joinedload('day_attribute', innerjoin=True),
-            joinedload('restriction'),
-            *(load_only(_) for _ in ('line', 'course_id', 'line_dir', 'day_attribute_id', 'restriction_id'))
-        ).join(network.Course)
+        .options(load_only('version_id', 'line', 'id', 'course_id')).join(network.Course)
     if version_id is not None:
         lq = lq.filter_by(version_id=version_id)
     total = 0
     rows = [("version", "line", "course", "km")]
     for versionid, version_grouper in itertools.groupby(lq.all(), lambda t_l: t_l[0].version_id):
         version_total = 0
+        service_days = session.query(Version).get(versionid).service_days
         for lineid, line_grouper in itertools.groupby(version_grouper, lambda t_l: t_l[0].line):
             line_total = 0
             for courseid, course_grouper in itertools.groupby(line_grouper, lambda t_l: t_l[0].course_id):
                 course_total = 0
                 for trip, length in course_grouper:
-                    days = len(trip.dates)
+                    days = service_days.count(trip)
                     km = days*(length/1000)
                     course_total += km
                 rows.append((versionid, lineid, courseid, f"{course_total:.2f}"))
@@ -164,30 +167,37 @@ def departure_stats(tripquery: Query, fname: str) -> None:
         writer(f, delimiter=";", lineterminator='\n').writerows(rows)
 
 
-def departures(stop: location.Stop, day: date, fname: str, days: int = 1) -> None:
-    """Departures from a given stop for a given date (range)"""
+def departures(stop: location.Stop, day: date, fname: str, days: int = 1, resolve_priority: bool = False) -> None:
+    """
+    Departures from a given stop for a given date (range), skipping dates where the stop's version is not effective if `resolve_priority`
+
+    Departures are computed once per `DINO2.model.schedule.ServiceDayClass` in the range and repeated for each of its dates.
+    """
     servinglines = set((c.line, c.id) for c in stop.courses)
+    version = stop._session.query(Version).get(stop.version_id)
+    service_days = version.service_days
+    version_calendar = calendar.VersionCalendar.for_session(stop._session)
+    classes = service_days.day_classes(day, day + timedelta(days=days-1))
+    keys = set(key for dc in classes for key in dc.trips)
+    tripquery = stop._session.query(schedule.Trip) \
+        .filter(
+            (schedule.Trip.version_id == stop.version_id)
+            & tuple_(schedule.Trip.line, schedule.Trip.course_id).in_(servinglines)
+        ).options(
+            load_only('version_id'), load_only('line'), load_only('id'), load_only('course_id'), load_only('line_dir'), load_only('timing_group'), load_only('departure_time'), load_only('arr_stop_id'),
+            joinedload('course', innerjoin=True).load_only('version_id').load_only('line').load_only('id').load_only('line_dir').load_only('name'),
+            joinedload('arr_stop').load_only('name')
+        )
+    stopdeps: Dict[Tuple[int, int], List[schedule.TripStop]] = {}
+    for trip, tripstops in schedule.Trip.trip_stops_for([t for t in tripquery.all() if (t.line, t.id) in keys], simple=True).items():
+        stopdeps[(trip.line, trip.id)] = [ts for n, ts in enumerate(tripstops, start=1) if ts.stop == stop and n != len(tripstops)]
     deps: List[Tuple[datetime, schedule.TripStop]] = []
-    for currdate in (day + timedelta(days=n) for n in range(days)):
-        tripquery = schedule.Trip.query_for_date(stop._session, currdate) \
-            .filter(
-                (schedule.Trip.version_id == stop.version_id)
-                & tuple_(schedule.Trip.line, schedule.Trip.course_id).in_(servinglines)
-            ).options(
-                load_only('version_id'), load_only('line'), load_only('id'), load_only('course_id'), load_only('line_dir'), load_only('timing_group'), load_only('departure_time'), load_only('arr_stop_id'),
-                joinedload('course', innerjoin=True).load_only('version_id').load_only('line').load_only('id').load_only('line_dir').load_only('name'),
-                joinedload('arr_stop').load_only('name')
-            )
-        trips = [(t, t.trip_stops(simple=True)) for t in tripquery.all()]
-        # todo: eventuell mal das trip_stops sich sparen koennen.
-        for trip, tripstops in trips:
-            deps.extend(
-                (datetime.combine(currdate, datetime.min.time()) + ts.dep_time, ts)
-                for n, ts
-                in filter(
-                    lambda n_ts: n_ts[1].stop == stop and n_ts[0] != len(tripstops),
-                    enumerate(tripstops, start=1)
-                ))
+    for dc in classes:
+        classdeps = [ts for key in dc.trips for ts in stopdeps.get(key, ())]
+        for currdate in dc.dates:
+            if resolve_priority and version_calendar.version_for(currdate, version.net) != version.id:
+                continue
+            deps.extend((datetime.combine(currdate, datetime.min.time()) + ts.dep_time, ts) for ts in classdeps)
     rows = [("date", "time", "plat", "linenum", "direction")]
     rows.extend(
         (
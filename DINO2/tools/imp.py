@@ -4,14 +4,33 @@
 
 from __future__ import annotations
 
+from argparse import ArgumentParser
 from collections import namedtuple
-from pandas import read_csv, Int64Dtype, isna, NA, Period, concat, to_datetime, DataFrame, Series
+from contextlib import ExitStack, contextmanager, nullcontext
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
+from datetime import date
+from gzip import GzipFile, open as gzip_open
+from functools import partial
+from hashlib import sha256
+from io import BufferedReader, RawIOBase, StringIO
+from itertools import count, islice
+import json
+from numpy import arange, dtype, empty, insert as insert_sorted, lexsort, logical_or, ndarray, zeros
+from pandas import read_csv, Int64Dtype, NA, to_numeric, DataFrame, MultiIndex
+from pandas.util import hash_pandas_object
+from sqlalchemy import Column, ForeignKeyConstraint, Integer, MetaData, String, Table, and_, exists, func, or_, select
+from sqlalchemy.engine import Connection, Dialect
 from sqlalchemy.orm.session import Session
+import os
 import sys
+from time import perf_counter
 from tqdm import tqdm
-from typing import Dict, Union, Callable, Any, Collection, FrozenSet, Optional, List, Type
+from typing import Dict, Union, Callable, Any, Collection, FrozenSet, Optional, List, Type, Iterator, IO, Set, Tuple
+from zipfile import ZipFile, is_zipfile
 
 from .. import Database
+from ..types import process_result_column
 from ..model import Base, Version, calendar, fares, location, operational, network, schedule
 
 # https://stackoverflow.com/questions/31394998/using-sqlalchemy-to-load-csv-file-into-a-database
@@ -20,115 +39,832 @@ from ..model import Base, Version, calendar, fares, location, operational, netwo
 encodings = {"WE8MSWIN1252": "windows-1252", None: "windows-1252"}
 
 
-def imp(dinodir: str, classes: Collection[Type[Base]], session: Session, version_ids: Optional[Collection[int]] = None) -> None:
-    """Import given tables for a version id (or all versions) of a DINO 2.1 dataset"""
-    character_set = read_csv(f"{dinodir}/character_set.din", sep=";", header=0, index_col=False, dtype={"VERSION": 'Int64', "CHARACTER_SET": 'object'}, skipinitialspace=True, quotechar='"', encoding=encodings[None])
-    encoding = encodings.get(next((r.CHARACTER_SET for r in character_set.itertuples(index=False) if (r.VERSION in version_ids if version_ids else True)), None))
+def clean(data: DataFrame, cls: Type[Base]) -> None:
+    """
+    Clean the columns of `data` known to `cls` in place, using whole-column operations
+
+    Strings are stripped, missing strings become `pandas.NA` (or `''` with column info `keep_empty_str`),
+    `-1` integers become `pandas.NA` unless `keep_minus_1` is set.
+    Like the former per-cell cleaning, `"-1"` strings are kept regardless of `str_minus_1_to_null`.
+    """
+    cls_parameters = cls._parameters()
+    for col in data:
+        if col not in cls_parameters:
+            continue
+        col_info = cls._col_info(cls_parameters[col])
+        column = data[col]
+        if column.dtype == 'object':
+            data[col] = column.str.strip().mask(column.isna(), '' if col_info.get('keep_empty_str') else NA)
+        elif isinstance(column.dtype, Int64Dtype) and not col_info.get('keep_minus_1'):
+            data[col] = column.mask(column.eq(-1).fillna(False))
+
+
+def convert(data: DataFrame, cls: Type[Base], progress: bool = True, column_keys: bool = False) -> List[Dict[str, Any]]:
+    """
+    Convert cleaned `data` to mappings for `cls`, with column types resolved once and each column converted at once
+
+    Mappings are keyed by `cls` parameters, or by column names with `column_keys`.
+    """
+    parameters = [(col, par) for col, par in cls._parameters().items() if col in data]
+    columns = [process_result_column(getattr(cls, par).type, data[col]) for col, par in parameters]
+    keys = tuple((col if column_keys else par) for col, par in parameters)
+    return [dict(zip(keys, row)) for row in tqdm(zip(*columns), total=data.shape[0], disable=not progress)]
+
+
+@contextmanager
+def open_din(dinodir: str, din_file: str) -> Iterator[IO[bytes]]:
+    """
+    Open `din_file` of a dataset for streaming reads, without extracting anything
+
+    `dinodir` is a directory of .din (or .din.gz) files or a .zip archive of them (possibly in a subdirectory).
+    """
+    with ExitStack() as stack:
+        if os.path.isfile(dinodir) and is_zipfile(dinodir):
+            archive = stack.enter_context(ZipFile(dinodir))
+            members = {name.rsplit("/", 1)[-1]: name for name in archive.namelist() if not name.endswith("/")}
+            if din_file in members:
+                f = stack.enter_context(archive.open(members[din_file]))
+            elif f"{din_file}.gz" in members:
+                f = stack.enter_context(GzipFile(fileobj=stack.enter_context(archive.open(members[f"{din_file}.gz"]))))
+            else:
+                raise FileNotFoundError(f"{din_file} not in {dinodir}")
+        elif not os.path.exists(f"{dinodir}/{din_file}") and os.path.exists(f"{dinodir}/{din_file}.gz"):
+            f = stack.enter_context(gzip_open(f"{dinodir}/{din_file}.gz"))
+        else:
+            f = stack.enter_context(open(f"{dinodir}/{din_file}", "rb"))
+        yield f
+
+
+class VersionFilter(RawIOBase):
+    """
+    Binary stream of the header line and the lines of versions `version_ids` of a .din file `f`, to drop other versions before parsing
+
+    Expects `VERSION` as first column (as in all DINO 2.1 files) and one line per row.
+    """
+    def __init__(self, f: IO[bytes], version_ids: Collection[int]):
+        self._lines = iter(f)
+        self._keep = frozenset(str(v).encode() for v in version_ids)
+        self._pending = next(self._lines, b"")
+        if self._pending.split(b";", 1)[0].strip() != b"VERSION":
+            raise ValueError(f"first column is not VERSION: {self._pending!r}")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = len(buffer)
+        lines, n = [self._pending], len(self._pending)
+        while n < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            if line.split(b";", 1)[0].strip() in self._keep:
+                lines.append(line)
+                n += len(line)
+        data = b"".join(lines)
+        buffer[:min(n, size)] = data[:size]
+        self._pending = data[size:]
+        return min(n, size)
+
+
+def _usecols(cls: Type[Base], warn: bool) -> Callable[[str], bool]:
+    """`read_csv` column filter for the columns of `cls`, warning about other columns"""
+    names = frozenset(cls._column_names())
+    unexpected: Set[str] = set()
+
+    def usecol(col: str) -> bool:
+        if col in names:
+            return True
+        if warn and not col.startswith("Unnamed: ") and col not in unexpected:
+            print(f"--> warning: Unexpected column '{col}'")
+        unexpected.add(col)
+        return False
+    return usecol
+
+
+def _read_csv(f: IO[bytes], cls: Type[Base], encoding: str, version_ids: Optional[Collection[int]], warn: bool, chunksize: Optional[int] = None) -> Union[DataFrame, Iterator[DataFrame]]:
+    if version_ids:
+        f = BufferedReader(VersionFilter(f, version_ids), 2**16)
+    return read_csv(f, sep=";", header=0, index_col=False, usecols=_usecols(cls, warn), dtype=cls._dtypes(), skipinitialspace=True, quotechar='"', encoding=encoding, chunksize=chunksize)
+
+
+def _read_chunks(dinodir: str, cls: Type[Base], encoding: str, chunksize: int, version_ids: Optional[Collection[int]], warn: bool) -> Iterator[DataFrame]:
+    with open_din(dinodir, cls._din_file) as f, _read_csv(f, cls, encoding, version_ids, warn, chunksize) as reader:
+        yield from reader
+
+
+def read(dinodir: str, cls: Type[Base], encoding: str, chunksize: Optional[int] = None, version_ids: Optional[Collection[int]] = None, warn: bool = True) -> Union[DataFrame, Iterator[DataFrame]]:
+    """
+    Parse the columns of `cls` from its .din file (see `open_din`), or return an iterator of `DataFrame`s with `chunksize` rows each
+
+    With `version_ids`, rows of other versions are dropped before parsing (see `VersionFilter`).
+    With `warn`, unexpected columns are printed.
+    """
+    if chunksize:
+        return _read_chunks(dinodir, cls, encoding, chunksize, version_ids, warn)
+    with open_din(dinodir, cls._din_file) as f:
+        return _read_csv(f, cls, encoding, version_ids, warn)
+
+
+def prepare(data: DataFrame, cls: Type[Base], version_ids: Optional[Collection[int]] = None, warn: bool = True) -> DataFrame:
+    """Select the versions of parsed `data` (if not done by `read`) and `clean` it, printing warnings about missing columns"""
+    if version_ids:
+        data = data[data.VERSION.isin(version_ids)]
+    if warn:
+        for mcol in cls._column_names():
+            if mcol not in data:
+                print(f"--> warning: Expected column '{mcol}' not in data")
+    clean(data, cls)
+    return data
+
+
+validity_classes = (location.Stop, location.StopArea, location.StopPoint)
+"""Classes whose rows of the same key are resolved by their `VALID_FROM`/`VALID_TO` dates (see `resolve_validity`)"""
+
+
+def validity_key(cls: Type[Base]) -> Optional[List[str]]:
+    """Primary key columns of `cls` if it is one of `validity_classes`, else None"""
+    if cls in validity_classes:
+        return [c.name for c in cls.__table__.primary_key]
+    return None
+
+
+def resolve_validity(data: DataFrame, key: List[str], today: Optional[date] = None) -> DataFrame:
+    """
+    Keep one row per `key`: the one valid `today` (default: today), else the one valid most recently
+
+    Rows are ranked by (valid today, already valid, `VALID_TO`, file position) in one sort over the parsed dates;
+    missing dates count as open validity periods.
+    """
+    today = today or date.today()
+    t = today.year * 10000 + today.month * 100 + today.day
+    valid_from = to_numeric(data["VALID_FROM"], errors="coerce").fillna(0).to_numpy()
+    valid_to = to_numeric(data["VALID_TO"], errors="coerce").fillna(99999999).to_numpy()
+    started = valid_from <= t
+    current = started & (valid_to >= t)
+    order = lexsort((arange(len(data)), valid_to, started, current))
+    return data.iloc[order].drop_duplicates(key, keep="last").sort_index()
+
+
+def dedupe(data: DataFrame, cls: Type[Base]) -> DataFrame:
+    """Drop duplicate rows, and for classes with a `validity_key` ambiguous rows of the same key (see `resolve_validity`)"""
+    data.drop_duplicates(inplace=True)
+    key = validity_key(cls)
+    if key is not None and {"VALID_FROM", "VALID_TO"}.issubset(data.columns):
+        data = resolve_validity(data, key)
+    return data
+
+
+def _whole_file(cls: Type[Base]) -> bool:
+    """Whether `dedupe` has to see all rows of `cls` at once"""
+    return validity_key(cls) is not None
+
+
+def reset_peak_memory() -> bool:
+    """Reset the peak resident set size reported by `peak_memory` (Linux only), returning whether it was reset"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_memory() -> Optional[int]:
+    """Peak resident set size of this process in bytes since the last `reset_peak_memory`, else since its start (None where unavailable)"""
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        pass
+    try:
+        from resource import getrusage, RUSAGE_SELF
+    except ImportError:
+        return None
+    peak = getrusage(RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+report_stages = ("read", "clean", "dedupe", "convert", "insert")
+"""Import stages timed in a `TableReport`"""
+
+
+@dataclass
+class TableReport:
+    """Timings (in seconds) of the import stages of one table, with its number of imported rows and the peak memory while importing it"""
+    din_file: str
+    """.din file of the table"""
+    rows: int = 0
+    """Imported rows"""
+    stages: Dict[str, float] = field(default_factory=lambda: dict.fromkeys(report_stages, 0.0))
+    """Seconds per stage (see `report_stages`), summed over chunks"""
+    peak_memory: Optional[int] = None
+    """Peak resident set size of the importing process in bytes while importing this table (see `peak_memory`)"""
+    peak_memory_cumulative: bool = False
+    """Whether `peak_memory` is the peak since the process started instead, where it can't be reset per table (see `reset_peak_memory`)"""
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Add the time spent in this context to stage `name`"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += perf_counter() - start
+
+    @property
+    def seconds(self) -> float:
+        """Total seconds of all stages"""
+        return sum(self.stages.values())
+
+    @property
+    def rows_per_second(self) -> Optional[float]:
+        """Imported rows per second over all stages"""
+        return self.rows / self.seconds if self.seconds else None
+
+    def as_dict(self) -> Dict[str, Any]:
+        """JSON-serializable dict of this report"""
+        return {**asdict(self), "seconds": self.seconds, "rows_per_second": self.rows_per_second}
+
+    def __str__(self) -> str:
+        stages = ", ".join(f"{name} {seconds:.3f} s" for name, seconds in self.stages.items())
+        text = f"{self.rows} rows in {self.seconds:.3f} s ({stages})"
+        if self.rows_per_second is not None:
+            text += f", {self.rows_per_second:.0f} rows/s"
+        if self.peak_memory is not None:
+            text += f", {'process ' if self.peak_memory_cumulative else ''}peak memory: {self.peak_memory / 2**20:.1f} MiB"
+        return text
+
+
+def insert_orm(session: Session, cls: Type[Base], mappings: List[Dict[str, Any]]) -> None:
+    """Insert mappings keyed by `cls` parameters using `Session.bulk_insert_mappings`"""
+    session.bulk_insert_mappings(cls, mappings)
+
+
+def insert_core(session: Session, cls: Type[Base], rows: List[Dict[str, Any]], batchsize: int = 10000) -> None:
+    """Insert rows keyed by column names with `Table.insert()` executemany calls of up to `batchsize` rows, bypassing the ORM"""
+    table = cls.__table__
+    for start in range(0, len(rows), batchsize):
+        session.execute(table.insert(), rows[start:start + batchsize])
+
+
+def _copy_value(value: Any) -> str:
+    """Field of a PostgreSQL CSV `COPY` (unquoted empty for NULL, strings always quoted)"""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
+
+
+def copy_csv(table: Table, rows: List[Dict[str, Any]], dialect: Dialect) -> str:
+    """CSV text of `rows` keyed by column names for `COPY table FROM STDIN`, with values bound as for `dialect` (see `insert_copy`)"""
+    processors = [(c.name, c.type.bind_processor(dialect)) for c in table.columns]
+    lines = []
+    for row in rows:
+        fields = ((p(row.get(name)) if p else row.get(name)) for name, p in processors)
+        lines.append(",".join(_copy_value(v) for v in fields))
+    return "".join(line + "\n" for line in lines)
+
+
+def insert_copy(session: Session, cls: Type[Base], rows: List[Dict[str, Any]], batchsize: int = 100000) -> None:
+    """
+    Insert rows keyed by column names with PostgreSQL `COPY FROM STDIN` (using psycopg2) in batches of up to `batchsize` rows,
+    or with `insert_core` on other databases
+    """
+    connection = session.connection()
+    if (connection.dialect.name, connection.dialect.driver) != ("postgresql", "psycopg2"):
+        insert_core(session, cls, rows)
+        return
+    table = cls.__table__
+    statement = f"COPY {connection.dialect.identifier_preparer.format_table(table)} ({', '.join(connection.dialect.identifier_preparer.quote(c.name) for c in table.columns)}) FROM STDIN WITH (FORMAT csv)"
+    with connection.connection.cursor() as cursor:
+        for start in range(0, len(rows), batchsize):
+            cursor.copy_expert(statement, StringIO(copy_csv(table, rows[start:start + batchsize], connection.dialect)))
+
+
+@dataclass(frozen=True)
+class Backend:
+    """How converted rows are written to the database"""
+    insert: Callable[[Session, Type[Base], List[Dict[str, Any]]], None]
+    """Insert function"""
+    column_keys: bool = False
+    """Whether rows are keyed by column names instead of `DINO2.model.Base` parameters (see `convert`)"""
+    commit_per_table: bool = False
+    """Whether to commit after each table"""
+
+
+backends = {
+    "orm": Backend(insert_orm),
+    "core": Backend(insert_core, column_keys=True, commit_per_table=True),
+    "copy": Backend(insert_copy, column_keys=True, commit_per_table=True),
+}
+"""Available `Backend`s"""
+
+
+_second_hash_key = "DINO2 chunk rows"
+"""`hash_pandas_object` key of the second row hash in `imp_chunked` (16 characters, differing from the default key)"""
+
+_row_hash = dtype([("a", "<u8"), ("b", "<u8")])
+"""128-bit row hash of `imp_chunked` as two 64-bit hashes (16 bytes per imported row)"""
+
+
+def _row_hashes(chunk: DataFrame) -> ndarray:
+    """`_row_hash`es of the rows of `chunk`"""
+    hashes = empty(chunk.shape[0], dtype=_row_hash)
+    hashes["a"] = hash_pandas_object(chunk, index=False).to_numpy()
+    hashes["b"] = hash_pandas_object(chunk, index=False, hash_key=_second_hash_key).to_numpy()
+    return hashes
+
+
+def imp_chunked(dinodir: str, cls: Type[Base], session: Session, encoding: str, version_ids: Optional[Collection[int]] = None, chunksize: int = 100000, backend: Backend = backends["orm"], report: Optional[TableReport] = None) -> TableReport:
+    """
+    Import a table in chunks of `chunksize` rows, keeping only one chunk (and a hash per imported row) in memory
+
+    Duplicates within a chunk are compared on full rows, those of earlier chunks on a 128-bit hash of them (see `_row_hash`),
+    kept in one sorted array.
+    """
+    report = report or TableReport(cls._din_file)
+    seen = empty(0, dtype=_row_hash)
+    with tqdm(unit=" rows") as progress:
+        chunks = read(dinodir, cls, encoding, chunksize, version_ids)
+        for ci in count():
+            with report.stage("read"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            with report.stage("clean"):
+                chunk = prepare(chunk, cls, version_ids, warn=(ci == 0))
+            with report.stage("dedupe"):
+                keys = _row_hashes(chunk)
+                positions = seen.searchsorted(keys)
+                new = ~chunk.duplicated().to_numpy() & (seen[positions.clip(max=len(seen) - 1)] != keys if len(seen) else True)
+                added = keys[new]
+                added.sort()
+                seen = insert_sorted(seen, seen.searchsorted(added), added)
+                chunk = chunk[new]
+            with report.stage("convert"):
+                rows = convert(chunk, cls, progress=False, column_keys=backend.column_keys)
+            with report.stage("insert"):
+                backend.insert(session, cls, rows)
+            report.rows += len(rows)
+            progress.update(len(rows))
+    return report
+
+
+def parse(dinodir: str, cls: Type[Base], encoding: str, version_ids: Optional[Collection[int]] = None, column_keys: bool = False, report: Optional[TableReport] = None, warn: bool = True) -> List[Dict[str, Any]]:
+    """Read, prepare, dedupe and convert a whole table (also used in worker processes), timing the stages in `report`"""
+    report = report or TableReport(cls._din_file)
+    with report.stage("read"):
+        data = read(dinodir, cls, encoding, version_ids=version_ids, warn=warn)
+    with report.stage("clean"):
+        data = prepare(data, cls, version_ids, warn=warn)
+    with report.stage("dedupe"):
+        data = dedupe(data, cls)
+    with report.stage("convert"):
+        return convert(data, cls, progress=False, column_keys=column_keys)
+
+
+def _parse_with_report(dinodir: str, cls: Type[Base], encoding: str, version_ids: Optional[Collection[int]], column_keys: bool) -> Tuple[List[Dict[str, Any]], TableReport]:
+    report = TableReport(cls._din_file)
+    return parse(dinodir, cls, encoding, version_ids, column_keys, report), report
+
+
+def _fk_dependencies(classes: Collection[Type[Base]]) -> Dict[Type[Base], Set[Type[Base]]]:
+    """Classes among `classes` that each class refers to by its `ForeignKeyConstraint`s"""
+    by_table = {cls.__table__: cls for cls in classes}
+    return {
+        cls: {by_table[fk.referred_table] for fk in cls.__table__.foreign_key_constraints if fk.referred_table in by_table} - {cls}
+        for cls in classes}
+
+
+def fk_dependents(classes: Collection[Type[Base]], changed: Collection[Type[Base]]) -> Set[Type[Base]]:
+    """Classes among `classes` that refer to any of `changed` directly or indirectly, and so have to be reloaded with them"""
+    dependencies = _fk_dependencies(classes)
+    reload, dependents = set(changed), set()
+    while True:
+        found = {cls for cls in classes if cls not in reload and dependencies[cls] & reload}
+        if not found:
+            return dependents
+        reload |= found
+        dependents |= found
+
+
+def fk_order(classes: Collection[Type[Base]]) -> List[Type[Base]]:
+    """
+    Sort `classes` so that each class comes after the classes its `ForeignKeyConstraint`s refer to
+
+    Keeps the given order where possible. References to tables of other classes are ignored.
+    """
+    dependencies = _fk_dependencies(classes)
+    ordered: List[Type[Base]] = []
+    while len(ordered) < len(classes):
+        cls = next((c for c in classes if c not in ordered and dependencies[c].issubset(ordered)), None)
+        if cls is None:
+            raise ValueError(f"circular foreign keys between {', '.join(c.__name__ for c in classes if c not in ordered)}")
+        ordered.append(cls)
+    return ordered
+
+
+def _imp_parallel(dinodir: str, classes: Collection[Type[Base]], session: Session, encoding: str, version_ids: Optional[Collection[int]], processes: Optional[int], backend: Backend, checkpoint: Optional[Callable[[Type[Base]], None]] = None) -> List[TableReport]:
+    """
+    Parse tables in a pool of `processes` processes while inserting them in `fk_order`
+
+    Only as many tables as there are processes are parsed or waiting to be inserted at a time,
+    the next one is submitted when a parsed table is taken for inserting.
+    """
+    ordered = fk_order(classes)
+    reports = []
+    with ProcessPoolExecutor(processes) as pool:
+        queue = iter(ordered)
+        futures: Dict[Type[Base], Future] = {}
+
+        def submit() -> None:
+            cls = next(queue, None)
+            if cls is not None:
+                futures[cls] = pool.submit(_parse_with_report, dinodir, cls, encoding, version_ids, backend.column_keys)
+        for _ in range(processes or os.cpu_count() or 1):
+            submit()
+        for ci, cls in enumerate(ordered, start=1):
+            print(f"[{ci}/{len(ordered)}] inserting {cls} (file {cls._din_file})")
+            reset = reset_peak_memory()
+            rows, report = futures.pop(cls).result()
+            submit()
+            with report.stage("insert"):
+                backend.insert(session, cls, rows)
+                if backend.commit_per_table:
+                    if checkpoint is not None:
+                        checkpoint(cls)
+                    session.commit()
+            report.rows = len(rows)
+            del rows
+            report.peak_memory, report.peak_memory_cumulative = peak_memory(), not reset
+            print(f"--> {report} (peak memory without worker processes)")
+            reports.append(report)
+    print()
+    return reports
+
+
+bookkeeping = MetaData()
+"""Metadata for the importer's own tables"""
+
+import_files = Table(
+    "import_file", bookkeeping,
+    Column("VERSION", Integer(), primary_key=True),
+    Column("DIN_FILE", String(length=64), primary_key=True),
+    Column("HASH", String(length=64), nullable=False))
+"""Content hash of each .din file per imported version, for incremental imports"""
+
+checkpoints = Table(
+    "import_checkpoint", bookkeeping,
+    Column("INPUT_HASH", String(length=64), primary_key=True),
+    Column("VERSION", Integer(), primary_key=True),
+    Column("DIN_FILE", String(length=64), primary_key=True))
+"""Tables completed by resumable imports, per `input_hash`"""
+
+
+def file_hash(dinodir: str, din_file: str, encoding: str) -> str:
+    """SHA-256 hex digest of a .din file (and the encoding it is read with)"""
+    digest = sha256(encoding.encode())
+    with open_din(dinodir, din_file) as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _changed(dinodir: str, classes: Collection[Type[Base]], session: Session, encoding: str, version_ids: Collection[int]) -> Dict[Type[Base], str]:
+    """Hashes of the files of `classes` that changed for any of `version_ids` since they were last imported"""
+    import_files.create(session.connection(), checkfirst=True)
+    recorded = {
+        (r.VERSION, r.DIN_FILE): r.HASH
+        for r in session.execute(select([import_files]).where(import_files.c.VERSION.in_(version_ids)))}
+    hashes = {cls: file_hash(dinodir, cls._din_file, encoding) for cls in classes}
+    return {cls: h for cls, h in hashes.items() if any(recorded.get((v, cls._din_file)) != h for v in version_ids)}
+
+
+def input_hash(dinodir: str, classes: Collection[Type[Base]], encoding: str, version_ids: Collection[int]) -> str:
+    """SHA-256 hex digest identifying an import of `classes` and `version_ids` from a dataset, by the `file_hash`es of its files"""
+    digest = sha256(",".join(str(v) for v in sorted(version_ids)).encode())
+    for cls in classes:
+        digest.update(f"{cls._din_file}:{file_hash(dinodir, cls._din_file, encoding)}".encode())
+    return digest.hexdigest()
+
+
+def dataset_versions(dinodir: str, encoding: str) -> FrozenSet[int]:
+    """Version ids of a dataset, from its version.din"""
+    return frozenset(int(v) for v in read(dinodir, Version, encoding, warn=False).VERSION)
+
+
+def _checkpoint(session: Session, run: str, version_ids: Collection[int], cls: Type[Base]) -> None:
+    session.execute(checkpoints.insert(), [{"INPUT_HASH": run, "VERSION": v, "DIN_FILE": cls._din_file} for v in version_ids])
+
+
+def rollback_versions(session: Session, classes: Collection[Type[Base]], version_ids: Optional[Collection[int]] = None) -> None:
+    """Delete the rows of `version_ids` (or all rows) from the tables of `classes`, in reverse `fk_order`, and the importer's bookkeeping of them"""
+    bookkeeping.create_all(session.connection())
+    derived = [cls for cls in (calendar.RestrictionDay,) if cls not in classes]
+    for table in [cls.__table__ for cls in reversed(fk_order([*classes, *derived]))] + [import_files, checkpoints]:
+        session.execute(table.delete().where(table.c.VERSION.in_(version_ids)) if version_ids else table.delete())
+
+
+def materialize_restriction_days(session: Session, version_ids: Optional[Collection[int]] = None, chunksize: int = 100000) -> int:
+    """
+    (Re)build the `DINO2.model.calendar.RestrictionDay`s of `version_ids` (or all versions) from the imported restrictions, returning their number
+
+    Days are inserted in batches of `chunksize` rows while the restrictions are expanded, so only one batch is held in memory.
+    """
+    table, restrictions = calendar.RestrictionDay.__table__, calendar.Restriction.__table__
+    session.execute(table.delete().where(table.c.VERSION.in_(version_ids)) if version_ids else table.delete())
+    query = select([restrictions.c.VERSION, restrictions.c.RESTRICTION, restrictions.c.LINE_NR, restrictions.c.RESTRICTION_DAYS, restrictions.c.DATE_FROM, restrictions.c.DATE_UNTIL])
+    if version_ids:
+        query = query.where(restrictions.c.VERSION.in_(version_ids))
+    days, total = calendar.RestrictionDay.from_restrictions(session.execute(query).fetchall()), 0
+    for rows in iter(lambda: list(islice(days, chunksize)), []):
+        insert_core(session, calendar.RestrictionDay, rows)
+        total += len(rows)
+    return total
+
+
+def dataset_encoding(dinodir: str, version_ids: Optional[Collection[int]] = None) -> str:
+    """Encoding of the .din files of a dataset (of the first of `version_ids`), from its character_set.din"""
+    with open_din(dinodir, "character_set.din") as f:
+        character_set = read_csv(f, sep=";", header=0, index_col=False, dtype={"VERSION": 'Int64', "CHARACTER_SET": 'object'}, skipinitialspace=True, quotechar='"', encoding=encodings[None])
+    return encodings.get(next((r.CHARACTER_SET for r in character_set.itertuples(index=False) if (r.VERSION in version_ids if version_ids else True)), None))
+
+
+def imp(dinodir: str, classes: Collection[Type[Base]], session: Session, version_ids: Optional[Collection[int]] = None, chunksize: Optional[int] = None, processes: Optional[int] = None, backend: str = "orm", incremental: bool = False, resume: bool = False, restriction_days: bool = False) -> List[TableReport]:
+    """
+    Import given tables for a version id (or all versions) of a DINO 2.1 dataset
+
+    With `chunksize`, tables are streamed in chunks of that many rows (see `imp_chunked`),
+    except for those that have to be deduplicated as a whole.  
+    With `processes`, tables are `parse`d in a pool of that many processes (0: one per cpu),
+    while this process inserts them in `fk_order`.  
+    `backend` selects one of `backends`.  
+    With `incremental`, only tables whose file changed since the last incremental import (see `import_files`) are imported,
+    together with the tables referring to them (see `fk_dependents`),
+    after deleting their rows of the imported versions; all in the transaction of `session`.  
+    With `resume`, each table is committed together with its row in `checkpoints`, and tables already completed
+    for the same `input_hash` are skipped (see `rollback_versions` to drop a partially imported version instead).  
+    With `restriction_days`, `materialize_restriction_days` runs afterwards.
+
+    Returns a `TableReport` per imported table.
+    """
+    _backend = backends[backend]
+    if chunksize and processes is not None:
+        raise ValueError("chunksize and processes can't be combined")
+    if incremental and (_backend.commit_per_table or resume):
+        raise ValueError(f"incremental imports need one transaction, {'resume' if resume else f'backend {backend}'} commits per table")
+    encoding = dataset_encoding(dinodir, version_ids)
+    if incremental:
+        version_ids = version_ids or dataset_versions(dinodir, encoding)
+        changed = _changed(dinodir, classes, session, encoding, version_ids)
+        dependents = fk_dependents(classes, changed)
+        print(f"unchanged: {', '.join(cls.__name__ for cls in classes if cls not in changed) or '-'}")
+        if dependents:
+            print(f"reloaded for foreign keys: {', '.join(cls.__name__ for cls in classes if cls in dependents)}")
+        classes = [cls for cls in fk_order(classes) if cls in changed or cls in dependents]
+        derived = [calendar.RestrictionDay] if calendar.Restriction in classes and calendar.RestrictionDay not in classes else []
+        for cls in reversed(fk_order([*classes, *derived])):
+            session.execute(cls.__table__.delete().where(cls.__table__.c.VERSION.in_(version_ids)))
+    checkpoint: Optional[Callable[[Type[Base]], None]] = None
+    if resume:
+        version_ids = version_ids or dataset_versions(dinodir, encoding)
+        run = input_hash(dinodir, classes, encoding, version_ids)
+        checkpoints.create(session.connection(), checkfirst=True)
+        done = set(session.execute(select([checkpoints.c.DIN_FILE]).where(checkpoints.c.INPUT_HASH == run)).scalars())
+        print(f"resuming import {run[:12]}, completed: {', '.join(cls.__name__ for cls in classes if cls._din_file in done) or '-'}")
+        classes = [cls for cls in classes if cls._din_file not in done]
+        _backend = replace(_backend, commit_per_table=True)
+        checkpoint = partial(_checkpoint, session, run, version_ids)
     print(f"version_ids: {version_ids}\nclasses: {', '.join(cls.__name__ for cls in classes)}\nencoding: {encoding}\n")
-    for ci, cls in enumerate(classes, start=1):
-        print(f"[{ci}/{len(classes)}] importing {cls} (file {cls._din_file})")
-        data = read_csv(f"{dinodir}/{cls._din_file}", sep=";", header=0, index_col=False, dtype=cls._dtypes(), skipinitialspace=True, quotechar='"', encoding=encoding)
-        if version_ids:
-            data = data[data.VERSION.isin(version_ids)]
-        cls_col_names = cls._column_names()
-        cls_parameters = cls._parameters()
-        for col in data:
-            if col not in cls_col_names:
-                if col != f"Unnamed: {len(data.columns) - 1}":
-                    print(f"--> warning: Unexpected column '{col}'")
+    if processes is not None:
+        reports = _imp_parallel(dinodir, classes, session, encoding, version_ids, processes or None, _backend, checkpoint)
+    else:
+        reports = []
+        for ci, cls in enumerate(classes, start=1):
+            print(f"[{ci}/{len(classes)}] importing {cls} (file {cls._din_file})")
+            report = TableReport(cls._din_file)
+            reset = reset_peak_memory()
+            if chunksize and not _whole_file(cls):
+                imp_chunked(dinodir, cls, session, encoding, version_ids, chunksize, _backend, report)
+            else:
+                rows = parse(dinodir, cls, encoding, version_ids, _backend.column_keys, report)
+                with report.stage("insert"):
+                    _backend.insert(session, cls, rows)
+                report.rows = len(rows)
+            if _backend.commit_per_table:
+                with report.stage("insert"):
+                    if checkpoint is not None:
+                        checkpoint(cls)
+                    session.commit()
+            report.peak_memory, report.peak_memory_cumulative = peak_memory(), not reset
+            print(f"--> {report}\n")
+            reports.append(report)
+    if incremental and changed:
+        session.execute(import_files.delete().where(import_files.c.VERSION.in_(version_ids) & import_files.c.DIN_FILE.in_([cls._din_file for cls in changed])))
+        session.execute(import_files.insert(), [{"VERSION": v, "DIN_FILE": cls._din_file, "HASH": h} for cls, h in changed.items() for v in version_ids])
+    if restriction_days:
+        print(f"materialized {materialize_restriction_days(session, version_ids, chunksize or 100000)} restriction days")
+    return reports
+
+
+def all_classes() -> List[Type[Base]]:
+    """All importable model classes, starting with `DINO2.model.Version`"""
+    classes: List[Type[Base]] = [Version]
+    for module in (calendar, fares, location, operational, network, schedule):
+        for attr in dir(module):
+            cls = getattr(module, attr)
+            if (not isinstance(cls, type)
+                or cls == Base
+                or cls == Version
+                or not issubclass(cls, Base)
+                or getattr(cls, '__abstract__', False)
+                or attr[0] == '_'
+                or not cls._din_file.endswith('.din')
+                ): continue
+            classes.append(cls)
+    return classes
+
+
+sqlite_fast_load_pragmas = {"journal_mode": "MEMORY", "synchronous": "OFF", "cache_size": "-262144", "temp_store": "MEMORY"}
+"""SQLite pragmas used by `sqlite_fast_load` (rollback journal in memory, no syncing, 256 MiB page cache, temporary tables in memory)"""
+
+
+@contextmanager
+def sqlite_fast_load(connection: Connection, foreign_keys_off: bool = False) -> Iterator[None]:
+    """
+    Use `sqlite_fast_load_pragmas` on `connection` while importing into SQLite (no-op for other databases)
+
+    The previous settings are restored on exit, so the import transaction has to be finished by then.
+    With `foreign_keys_off`, foreign key enforcement is switched off as well (use `check_foreign_keys` instead).
+    """
+    if connection.dialect.name != "sqlite":
+        yield
+        return
+    pragmas = dict(sqlite_fast_load_pragmas, **({"foreign_keys": "OFF"} if foreign_keys_off else {}))
+    previous = {pragma: connection.exec_driver_sql(f"PRAGMA {pragma}").scalar() for pragma in pragmas}
+    for pragma, value in pragmas.items():
+        connection.exec_driver_sql(f"PRAGMA {pragma}={value}")
+    try:
+        yield
+    finally:
+        for pragma, value in previous.items():
+            connection.exec_driver_sql(f"PRAGMA {pragma}={value}")
+
+
+def foreign_key_groups(table: Table) -> List[List[ForeignKeyConstraint]]:
+    """
+    `ForeignKeyConstraint`s of `table`, grouped as alternatives
+
+    Constraints to the same table with nested columns (like `DINO2.model.schedule.Trip` to `DINO2.model.calendar.Restriction`
+    with and without `line`) are alternatives, a row only has to satisfy one of them.
+    """
+    groups: List[List[ForeignKeyConstraint]] = []
+    for fk in sorted(table.foreign_key_constraints, key=lambda fk: (fk.referred_table.name, fk.column_keys)):
+        cols = set(fk.column_keys)
+        group = next((g for g in groups if g[0].referred_table is fk.referred_table and any(cols <= set(a.column_keys) or cols >= set(a.column_keys) for a in g)), None)
+        if group is None:
+            groups.append([fk])
+        else:
+            group.append(fk)
+    return groups
+
+
+def foreign_key_name(fks: Collection[ForeignKeyConstraint]) -> str:
+    """Readable description of a group of alternative `ForeignKeyConstraint`s"""
+    return " | ".join(f"{fk.parent.name}({', '.join(fk.column_keys)}) -> {fk.referred_table.name}({', '.join(e.column.name for e in fk.elements)})" for fk in fks)
+
+
+def check_foreign_keys(connection: Connection, classes: Collection[Type[Base]]) -> None:
+    """
+    Check the foreign keys of the tables of `classes` (including uncommitted rows) using one query per `foreign_key_groups` group,
+    raising `ValueError` for violations
+
+    Rows with a missing value in a foreign key are not checked for that key.
+    """
+    violations = {}
+    for cls in classes:
+        table = cls.__table__
+        for fks in foreign_key_groups(table):
+            applicable = [and_(*(table.c[col] != None for col in fk.column_keys)) for fk in fks]
+            matches = [exists().where(and_(*(e.parent == e.column for e in fk.elements))) for fk in fks]
+            violating = and_(or_(*applicable), *(or_(~a, ~m) for a, m in zip(applicable, matches)))
+            count = connection.execute(select([func.count()]).select_from(table).where(violating)).scalar()
+            if count:
+                violations[foreign_key_name(fks)] = count
+    if violations:
+        raise ValueError(f"{sum(violations.values())} foreign key violations: " + "; ".join(f"{fk}: {count}" for fk, count in violations.items()))
+
+
+def _matches(data: DataFrame, columns: List[str], referred: DataFrame, referred_columns: List[str]) -> ndarray:
+    """Whether the values of `columns` of each row of `data` occur as values of `referred_columns` in `referred`"""
+    if not all(c in referred for c in referred_columns):
+        return zeros(data.shape[0], dtype=bool)
+    left, right = data[columns], referred[referred_columns].set_axis(columns, axis=1)
+    for col in columns:
+        if left[col].dtype != right[col].dtype:
+            left, right = left.astype({col: object}), right.astype({col: object})
+    return MultiIndex.from_frame(left).isin(MultiIndex.from_frame(right))
+
+
+def validate(frames: Dict[Type[Base], DataFrame]) -> Dict[str, DataFrame]:
+    """
+    Check primary key uniqueness and the `foreign_key_groups` of parsed `frames` (as `dedupe`d for import) with vectorized joins
+
+    Returns the offending rows per violated constraint.
+    Constraints referring to tables not in `frames`, and rows with a missing value in a foreign key, are not checked.
+    """
+    violations = {}
+    by_table = {cls.__table__: data for cls, data in frames.items()}
+    for cls, data in frames.items():
+        table = cls.__table__
+        pk = [c.name for c in table.primary_key if c.name in data]
+        duplicated = data.duplicated(pk, keep=False)
+        if duplicated.any():
+            violations[f"{table.name}({', '.join(pk)}) primary key"] = data[duplicated]
+        for fks in foreign_key_groups(table):
+            if fks[0].referred_table not in by_table:
                 continue
-            col_info = cls._col_info(cls_parameters[col])
-            if data[col].dtype == 'object':
-                data[col] = data[col].map(
-                    lambda s: (
-                        ('' if col_info.get('keep_empty_str') else NA)
-                        if (isna(s) or (col.strip() == "-1" and col_info.get('str_minus_1_to_null')))
-                        else s.strip()
-                    ))
-            elif isinstance(data[col].dtype, Int64Dtype) and not col_info.get('keep_minus_1'):
-                data[col] = data[col].map(lambda i: NA if (not isna(i) and i == -1) else i)
-        missing_cols = frozenset(ccol for ccol in cls_col_names if ccol not in data)
-        for mcol in missing_cols:
-            print(f"--> warning: Expected column '{mcol}' not in data")
-        data.drop_duplicates(inplace=True)
-        if cls._din_file == "stop.din":
-            dupes = data[data.duplicated({'VERSION', 'STOP_NR'}, keep=False)]
-            data.drop(dupes.index, inplace=True)
-            deduped = DataFrame()
-
-            def mask_fn(g: DataFrame) -> Series:
-                """Mask for a group of a DataFrame, only keeps one row (the one that is valid today or the one that was valid most recently)"""
-                # see https://pandas-docs.github.io/pandas-docs-travis/user_guide/timeseries.html#timeseries-oob
-                v_f = g['VALID_FROM'].astype(int).apply(lambda s: Period(year=int(s) // 10000, month=int(s) // 100 % 100, day=int(s) % 100, freq='D'))
-                v_t = g['VALID_TO'].astype(int).apply(lambda s: Period(year=int(s) // 10000, month=int(s) // 100 % 100, day=int(s) % 100, freq='D'))
-                v_f_t = concat([v_f, v_t], axis=1)
-                _today_dt = to_datetime('today')
-                today = Period(year=_today_dt.year, month=_today_dt.month, day=_today_dt.day, freq='D')
-                now = (today >= v_f_t['VALID_FROM']) & (v_f_t['VALID_TO'] >= today)
-                if not now.any():
-                    now.iloc[-1] = True
-                return now
-
-            grouped = dupes.groupby(['VERSION', 'STOP_NR'])
-            for name, group in grouped:
-                deduped = concat([deduped, group[mask_fn]])
-            data = concat([data, deduped])
-        objs: List[Base] = []
-
-        def value(v: Optional[Any], par: str) -> Optional[Any]:
-            if isna(v):
-                v = None
-            col_type = getattr(cls, par).type
-            if hasattr(col_type, "process_result_value"):
-                return col_type.process_result_value(v)
-            return v
-
-        mappings = []
-        for r in tqdm(data.itertuples(index=False), total=data.shape[0]):
-            mappings.append(
-                {
-                    _p: value(getattr(r, _c), _p)
-                    for _c, _p in cls_parameters.items()
-                    if _c not in missing_cols
-                })
-        session.bulk_insert_mappings(cls, mappings)
-        print()
+            referred = by_table[fks[0].referred_table]
+            applicable = [data[list(fk.column_keys)].notna().all(axis=1).to_numpy() if all(c in data for c in fk.column_keys) else zeros(data.shape[0], dtype=bool) for fk in fks]
+            violating = logical_or.reduce(applicable)
+            for fk, a in zip(fks, applicable):
+                if a.any():
+                    violating &= ~a | ~_matches(data, list(fk.column_keys), referred, [e.column.name for e in fk.elements])
+            if violating.any():
+                violations[foreign_key_name(fks)] = data[violating]
+    return violations
+
+
+def validate_dataset(dinodir: str, classes: Collection[Type[Base]], version_ids: Optional[Collection[int]] = None) -> Dict[str, DataFrame]:
+    """Parse the tables of `classes` like `imp` does (without writing anything) and `validate` them"""
+    encoding = dataset_encoding(dinodir, version_ids)
+    frames = {cls: dedupe(prepare(read(dinodir, cls, encoding, version_ids=version_ids, warn=False), cls, version_ids, warn=False), cls) for cls in classes}
+    return validate(frames)
+
+
+_options = ArgumentParser(prog="python -m DINO2.tools.imp <database url> <data directory or .zip> <c|a|versionids>", description="Options after the three positional arguments")
+_options.add_argument("--chunksize", type=int, default=None, help="stream tables in chunks of this many rows, to bound memory usage")
+_options.add_argument("--processes", type=int, default=None, help="parse tables in this many processes (0: one per cpu)")
+_options.add_argument("--backend", choices=tuple(backends), default="orm", help="insert using ORM bulk inserts, Core executemany calls, or COPY on PostgreSQL (Core elsewhere); core and copy commit per table")
+_options.add_argument("--sqlite-fast-load", action="store_true", help="use load-friendly pragmas during the import into SQLite, restored afterwards")
+_options.add_argument("--incremental", action="store_true", help="only re-import tables whose file changed since the last incremental import")
+_options.add_argument("--resume", action="store_true", help="commit per table and skip tables completed by an earlier --resume import of the same input")
+_options.add_argument("--rollback", action="store_true", help="instead of importing, delete all rows of the given versions (and the importer's bookkeeping of them)")
+_options.add_argument("--restriction-days", action="store_true", help="materialize the days of all restrictions in the table restriction_day, for date queries in SQL")
+_options.add_argument("--report", metavar="FILE", help="write the per-table timings (see TableReport) to a JSON file")
+_options.add_argument("--validate", action="store_true", help="check primary keys and foreign keys of the parsed data before writing anything, failing with the offending rows")
+_options.add_argument("--check-foreign-keys", action="store_true", help="check the foreign keys of all imported tables before committing (with --sqlite-fast-load: and do not enforce them during the import); not with --resume or backends that commit per table")
 
 
 def main(argv: Collection[str]):
     """Parse `argv` and call `imp`"""
-    if len(argv) != 4 or not (argv[3] in {"c", "a"} or all((c.isdigit() or c == ',') for c in argv[3])):
-        raise ValueError("3 arguments (database url like `sqlite:///./DINO2.db`, data directory, and ('c' (clear), 'a' (all), or ','-separated versionids)) required")
+    if len(argv) < 4 or not (argv[3] in {"c", "a"} or all((c.isdigit() or c == ',') for c in argv[3])):
+        raise ValueError("3 arguments (database url like `sqlite:///./DINO2.db`, data directory or .zip archive, and ('c' (clear), 'a' (all), or ','-separated versionids)) required, optionally followed by options (see --help)")
+    options = _options.parse_args(list(argv)[4:])
+    if options.check_foreign_keys and (backends[options.backend].commit_per_table or options.resume):
+        raise ValueError(f"--check-foreign-keys needs one transaction, {'--resume' if options.resume else f'backend {options.backend}'} commits per table")
 
     db = Database(argv[1])
     Base.metadata.create_all(db.engine)
 
     if argv[3] == "c":
         Base.metadata.drop_all(db.engine)
+        bookkeeping.drop_all(db.engine)
         Base.metadata.create_all(db.engine)
     else:
-        session = db.Session()
+        version_ids = set(int(v) for v in argv[3].split(',')) if argv[3] != "a" else None
+        classes = all_classes()
+        if options.rollback:
+            with db.Session() as session, session.begin():
+                rollback_versions(session, classes, version_ids)
+            return
+        if options.validate:
+            violations = validate_dataset(argv[2], classes, version_ids)
+            for name, rows in violations.items():
+                print(f"--> {name}: {rows.shape[0]} rows\n{rows.head().to_string()}\n")
+            if violations:
+                raise ValueError(f"{sum(rows.shape[0] for rows in violations.values())} rows violate constraints: " + "; ".join(f"{name}: {rows.shape[0]}" for name, rows in violations.items()))
+        connection = db.engine.connect()
+        session = db.Session(bind=connection)
+        fast_load = options.sqlite_fast_load and connection.dialect.name == "sqlite"
         try:
-            version_ids = set(int(v) for v in argv[3].split(',')) if argv[3] != "a" else None
-            classes = [Version]
-            for module in (calendar, fares, location, operational, network, schedule):
-                for attr in dir(module):
-                    cls = getattr(module, attr)
-                    if (not isinstance(cls, type)
-                        or cls == Base
-                        or cls == Version
-                        or not issubclass(cls, Base)
-                        or getattr(cls, '__abstract__', False)
-                        or attr[0] == '_'
-                        ): continue
-                    classes.append(cls)
-            imp(argv[2], classes, session, version_ids)
-            session.commit()
-        except Exception as e:
-            session.rollback()
-            raise e
+            with sqlite_fast_load(connection, options.check_foreign_keys) if fast_load else nullcontext():
+                try:
+                    reports = imp(argv[2], classes, session, version_ids, chunksize=options.chunksize, processes=options.processes, backend=options.backend, incremental=options.incremental, resume=options.resume, restriction_days=options.restriction_days)
+                    if options.check_foreign_keys:
+                        check_foreign_keys(session.connection(), classes)
+                    session.commit()
+                    if options.report:
+                        with open(options.report, "w") as f:
+                            json.dump({"data": argv[2], "version_ids": sorted(version_ids) if version_ids else None, "tables": [r.as_dict() for r in reports]}, f, indent=2)
+                except Exception as e:
+                    session.rollback()
+                    raise e
         finally:
             session.close()
+            connection.close()
 
 
 if __name__ == "__main__":
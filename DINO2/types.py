@@ -5,14 +5,43 @@ from __future__ import annotations
 
 from datetime import date, timedelta
 from enum import Enum
+from numpy import empty, ndarray
+from pandas import Series, factorize
 from sqlalchemy import String, Integer, cast, func
 from sqlalchemy.engine.interfaces import Dialect
 from sqlalchemy.types import TypeDecorator, TypeEngine
-from typing import Optional, Type, Tuple, Any, Union
+from typing import Optional, Type, Tuple, Any, Union, Callable
+
+
+def process_result_column(col_type: TypeEngine, values: Series) -> ndarray:
+    """
+    Convert a whole column of raw (imported) values for a column type at once
+
+    Uses `ColumnResultProcessor.process_result_column` where available,
+    otherwise only replaces missing values with `None` (and numpy by python scalars).
+    """
+    if isinstance(col_type, ColumnResultProcessor):
+        return col_type.process_result_column(values)
+    converted = values.astype(object).to_numpy(copy=True)
+    converted[values.isna().to_numpy()] = None
+    return converted
+
+
+class ColumnResultProcessor:
+    """Mixin for column types, converting whole columns of raw values at once"""
+    process_result_value: Callable[..., Optional[Any]]
+
+    def process_result_column(self, values: Series) -> ndarray:
+        """Convert a whole column, calling `process_result_value` only once per distinct value (and once for missing values)"""
+        codes, uniques = factorize(values)
+        converted = empty(len(uniques) + 1, dtype=object)
+        converted[:-1] = [self.process_result_value(v) for v in uniques.tolist()]
+        converted[-1] = self.process_result_value(None)
+        return converted[codes]
 
 
 # https://stackoverflow.com/q/35209650
-class DinoDate(TypeDecorator):
+class DinoDate(ColumnResultProcessor, TypeDecorator):
     """Column type for date strings in yyyymmdd format, converted to `datetime.date` objects"""
     impl = String(length=8)
 
@@ -49,7 +78,7 @@ class DinoDate(TypeDecorator):
         return None
 
 
-class DinoTimeDelta(TypeDecorator):
+class DinoTimeDelta(ColumnResultProcessor, TypeDecorator):
     """Column type for timedeltas saved as int in the database, converted to `datetime.timedelta` objects"""
     impl = Integer
     should_evaluate_none = True
@@ -88,7 +117,7 @@ class DinoTimeDelta(TypeDecorator):
 
 
 # https://stackoverflow.com/a/38786737
-class TypeEnum(TypeDecorator):
+class TypeEnum(ColumnResultProcessor, TypeDecorator):
     """Column type for python `enum.Enum`s stored in the database"""
     impl: Union[TypeEngine, Type[TypeEngine]] = TypeEngine
 
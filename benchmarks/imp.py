@@ -0,0 +1,149 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for `DINO2.tools.imp`
+
+Use e.g. with `python -m benchmarks.imp clean ./tests/data/2020-05-15-version-9`
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+from pandas import read_csv, isna, NA, Int64Dtype, DataFrame
+from pandas.testing import assert_frame_equal
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Collection, List, Type
+
+from DINO2 import Database
+from DINO2.model import Base
+from DINO2.tools.imp import all_classes, backends, clean, encodings, parse, read
+
+
+def _read(dinodir: str, cls: Type[Base]) -> DataFrame:
+    return read_csv(f"{dinodir}/{cls._din_file}", sep=";", header=0, index_col=False, dtype=cls._dtypes(), skipinitialspace=True, quotechar='"', encoding=encodings[None])
+
+
+def _best(fn: Callable[[], None], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def _available(dinodir: str) -> List[Type[Base]]:
+    return [cls for cls in all_classes() if os.path.exists(f"{dinodir}/{cls._din_file}")]
+
+
+def clean_per_cell(data: DataFrame, cls: Type[Base]) -> None:
+    """Reference: cleaning with one python call per cell, as `DINO2.tools.imp.imp` used to do"""
+    cls_parameters = cls._parameters()
+    for col in data:
+        if col not in cls_parameters:
+            continue
+        col_info = cls._col_info(cls_parameters[col])
+        if data[col].dtype == 'object':
+            data[col] = data[col].map(
+                lambda s: (
+                    ('' if col_info.get('keep_empty_str') else NA)
+                    if (isna(s) or (col.strip() == "-1" and col_info.get('str_minus_1_to_null')))
+                    else s.strip()
+                ))
+        elif isinstance(data[col].dtype, Int64Dtype) and not col_info.get('keep_minus_1'):
+            data[col] = data[col].map(lambda i: NA if (not isna(i) and i == -1) else i)
+
+
+def bench_clean(dinodir: str, repeat: int = 3) -> None:
+    """Per-cell vs. vectorized cleaning (`DINO2.tools.imp.clean`), checking for identical results"""
+    print(f"{'file':<32}{'rows':>8}{'per cell (s)':>14}{'vectorized (s)':>16}{'speedup':>9}")
+    total_old = total_new = 0.0
+    for cls in _available(dinodir):
+        data = _read(dinodir, cls)
+        old, new = data.copy(), data.copy()
+        clean_per_cell(old, cls)
+        clean(new, cls)
+        # the per-cell path leaves object columns behind for Int64 columns
+        assert_frame_equal(old.astype(object).where(old.notna(), None), new.astype(object).where(new.notna(), None))
+        t_old = _best(lambda: clean_per_cell(data.copy(), cls), repeat)
+        t_new = _best(lambda: clean(data.copy(), cls), repeat)
+        total_old += t_old
+        total_new += t_new
+        print(f"{cls._din_file:<32}{data.shape[0]:>8}{t_old:>14.4f}{t_new:>16.4f}{t_old / t_new:>8.1f}x")
+    print(f"{'total':<32}{'':>8}{total_old:>14.4f}{total_new:>16.4f}{total_old / total_new:>8.1f}x")
+
+
+def bench_insert(dinodir: str, repeat: int = 3, dburl: str = "sqlite://") -> None:
+    """ORM bulk inserts vs. Core executemany inserts (`DINO2.tools.imp.backends`), each into an empty table"""
+    db = Database(dburl)
+    Base.metadata.create_all(db.engine)
+    session = db.Session()
+
+    def insert(backend: str, cls: Type[Base], rows: List) -> None:
+        backends[backend].insert(session, cls, rows)
+        session.rollback()
+
+    print(f"{'file':<32}{'rows':>8}{'orm (s)':>10}{'core (s)':>10}{'speedup':>9}")
+    total_orm = total_core = 0.0
+    for cls in _available(dinodir):
+        mappings = parse(dinodir, cls, encodings[None], warn=False)
+        rows = parse(dinodir, cls, encodings[None], column_keys=True, warn=False)
+        if not rows:
+            continue
+        t_orm = _best(lambda: insert("orm", cls, mappings), repeat)
+        t_core = _best(lambda: insert("core", cls, rows), repeat)
+        total_orm += t_orm
+        total_core += t_core
+        print(f"{cls._din_file:<32}{len(rows):>8}{t_orm:>10.4f}{t_core:>10.4f}{t_orm / t_core:>8.1f}x")
+    print(f"{'total':<32}{'':>8}{total_orm:>10.4f}{total_core:>10.4f}{total_orm / total_core:>8.1f}x")
+    session.close()
+
+
+def _multiply_versions(dinodir: str, cls: Type[Base], target: str, copies: int) -> None:
+    """Write the .din file of `cls` to `target` with `copies` copies of every row, as versions 1001, 1002, .."""
+    with open(f"{dinodir}/{cls._din_file}", "rb") as f:
+        header, *lines = f.read().splitlines(keepends=True)
+    with open(f"{target}/{cls._din_file}", "wb") as f:
+        f.write(header)
+        for v in range(1001, 1001 + copies):
+            f.writelines(f"{v};".encode() + line.split(b";", 1)[1] for line in lines)
+
+
+def bench_versions(dinodir: str, repeat: int = 3, copies: int = 20) -> None:
+    """Parsing all rows and columns, then filtering, vs. `DINO2.tools.imp.read` with `version_ids`, on files with `copies` versions"""
+    with TemporaryDirectory() as target:
+        print(f"{'file':<32}{'rows':>8}{'parse all (s)':>15}{'pushed down (s)':>17}{'speedup':>9}")
+        total_old = total_new = 0.0
+        for cls in _available(dinodir):
+            _multiply_versions(dinodir, cls, target, copies)
+            old = _read(target, cls)
+            columns = [c for c in cls._column_names() if c in old]
+            old = old[old.VERSION.isin({1001})][columns]
+            new = read(target, cls, encodings[None], version_ids={1001}, warn=False)
+            assert_frame_equal(old.reset_index(drop=True), new[columns].reset_index(drop=True))
+            t_old = _best(lambda: (lambda d: d[d.VERSION.isin({1001})])(_read(target, cls)), repeat)
+            t_new = _best(lambda: read(target, cls, encodings[None], version_ids={1001}, warn=False), repeat)
+            total_old += t_old
+            total_new += t_new
+            print(f"{cls._din_file:<32}{old.shape[0] * copies:>8}{t_old:>15.4f}{t_new:>17.4f}{t_old / t_new:>8.1f}x")
+        print(f"{'total':<32}{'':>8}{total_old:>15.4f}{total_new:>17.4f}{total_old / total_new:>8.1f}x")
+
+
+benchmarks = {
+    "clean": bench_clean,
+    "insert": bench_insert,
+    "versions": bench_versions,
+}
+
+
+def main(argv: Collection[str]):
+    """Run the benchmark `argv[1]` on the data directory `argv[2]`"""
+    if len(argv) != 3 or argv[1] not in benchmarks:
+        raise ValueError(f"2 arguments (benchmark ({', '.join(benchmarks)}), data directory) required")
+    benchmarks[argv[1]](argv[2])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
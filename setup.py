@@ -19,6 +19,7 @@ setuptools.setup(
     install_requires=[
         "sqlalchemy",
         "pandas",
+        "numpy",
         "tqdm"
     ],
     classifiers=[
@@ -0,0 +1,62 @@
+from datetime import date
+
+from DINO2 import Database
+from DINO2.model import Version
+from DINO2.model.calendar import DayBitset, Restriction, RestrictionDay, VersionCalendar
+
+def test_daybitset_from_daystring():
+    # 2020-01: days 1 and 2 (and the unused bit 31); 2020-02: days 1 and 29
+    bs = DayBitset.from_daystring("8000000310000001", date(2020, 1, 2), date(2020, 2, 29))
+    assert bs.dates == {date(2020, 1, 2), date(2020, 2, 1), date(2020, 2, 29)}
+    assert (bs.first, bs.last, len(bs)) == (date(2020, 1, 2), date(2020, 2, 29), 3)
+    assert date(2020, 1, 1) not in bs and date(2020, 1, 2) in bs and date(2020, 3, 1) not in bs
+    assert DayBitset.from_daystring("8000000310000001", date(2020, 1, 2), date(2020, 2, 29)) is bs
+    assert Restriction.calc_dateset("8000000310000001", date(2020, 1, 1), date(2020, 2, 28)) == {date(2020, 1, 1), date(2020, 1, 2), date(2020, 2, 1)}
+
+def test_daybitset_operations():
+    a = DayBitset.from_dates([date(2020, 1, 1), date(2020, 1, 5), date(2020, 2, 1)])
+    b = DayBitset.from_dates([date(2020, 1, 5), date(2020, 2, 1), date(2020, 3, 1)])
+    assert (a & b).dates == {date(2020, 1, 5), date(2020, 2, 1)}
+    assert (a | b).dates == a.dates | b.dates
+    assert (a & {date(2020, 1, 1)}).dates == {date(2020, 1, 1)}
+    assert ({date(2020, 3, 1)} & b).dates == {date(2020, 3, 1)}
+    assert a.count() == 3 and a.count(date(2020, 1, 2)) == 2 and a.count(date(2020, 1, 2), date(2020, 1, 31)) == 1
+    assert list(b) == sorted(b.dates)
+    assert a == DayBitset.from_dates(a.dates) and a != b
+    empty = DayBitset.from_dates([])
+    assert len(empty) == 0 and empty.first is None and len(a & empty) == 0 and (a | empty) == a
+
+def test_restriction_day_rows():
+    rows = list(RestrictionDay.from_restrictions([(9, "A1", None, "8000000310000001", date(2020, 1, 2), date(2020, 2, 29))]))
+    assert [r["DAY"] for r in rows] == [date(2020, 1, 2), date(2020, 2, 1), date(2020, 2, 29)]
+    assert all(r["VERSION"] == 9 and r["RESTRICTION"] == "A1" and r["LINE_NR"] is None for r in rows)
+
+def test_version_calendar():
+    versions = [
+        Version(id=1, net="abc", date_from=date(2020, 1, 1), date_to=date(2020, 12, 31), priority=1),
+        Version(id=2, net="abc", date_from=date(2020, 3, 1), date_to=date(2020, 3, 10), priority=5),
+        Version(id=3, net="abc", date_from=date(2020, 3, 5), date_to=date(2020, 3, 20), priority=5),
+        Version(id=4, net="xyz", date_from=None, date_to=None, priority=None),
+    ]
+    vc = VersionCalendar(versions)
+    assert [vc.version_for(date(2020, 3, d), "abc") for d in (1, 4, 5, 10, 20, 21)] == [2, 2, 3, 3, 3, 1]
+    assert vc.version_for(date(2019, 12, 31), "abc") is None and vc.version_for(date(2020, 3, 1), "other") is None
+    assert vc.version_for(date(1999, 1, 1), "xyz") == 4 and vc.versions_for(date(2020, 6, 1)) == {1, 4}
+    assert vc.dates(2).dates == {date(2020, 3, d) for d in range(1, 5)}
+    assert len(vc.dates(1)) == 366 - 20
+
+def test_version_calendar_for_session():
+    db = Database("sqlite://")
+    Version.__table__.create(db.engine)
+    session = db.Session()
+    session.add(Version(id=1, net="abc", date_from=date(2020, 1, 1), date_to=date(2020, 12, 31), priority=1))
+    session.commit()
+    vc = VersionCalendar.for_session(session)
+    assert VersionCalendar.for_session(session) is vc and vc.version_for(date(2020, 3, 1), "abc") == 1
+    # recomputed after changes of the session are flushed, and after commits and rollbacks
+    session.add(Version(id=2, net="abc", date_from=date(2020, 3, 1), date_to=date(2020, 3, 10), priority=5))
+    session.flush()
+    assert VersionCalendar.for_session(session).version_for(date(2020, 3, 1), "abc") == 2
+    session.rollback()
+    assert VersionCalendar.for_session(session).version_for(date(2020, 3, 1), "abc") == 1
+    session.close()
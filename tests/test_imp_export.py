@@ -2,16 +2,31 @@ import pytest
 
 from datetime import date, timedelta
 from enum import Enum
+from pandas import DataFrame, Series, isna
+from pandas.testing import assert_frame_equal
+from numpy import array, concatenate, cumsum, diff, ones
+from numpy.testing import assert_array_equal
 from filecmp import cmp, dircmp
+import json
+from struct import pack, unpack_from
 import os
-from shutil import rmtree
-from sqlalchemy.exc import IntegrityError
+from gzip import open as gzip_open
+from shutil import copyfile, copyfileobj, copytree, rmtree
+from zipfile import ZipFile, ZIP_DEFLATED
+from sqlalchemy import inspect, select, func
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError, OperationalError
 
 from DINO2 import Database
-from DINO2.model import Version
-from DINO2.model.location import Stop
-from DINO2.model.schedule import Trip
-from DINO2.tools.imp import main
+from DINO2.model import Base, Version
+from DINO2.model.calendar import CalendarDay, DayAttribute, DayGrouping, DayType, Restriction, RestrictionDay
+from DINO2.model.fares import FareZone
+from DINO2.model.location import Link, LinkForcePoint, LinkGeometryStore, Stop, StopAdditionalName, StopArea, StopPoint
+from DINO2.model.network import Course, CourseStop
+from DINO2.model.schedule import Trip, TripVDT
+from DINO2.timetable import Timetable
+from DINO2.tools import imp as imp_module
+from DINO2.tools.imp import checkpoints, copy_csv, dataset_encoding, imp, imp_chunked, main, materialize_restriction_days, parse, peak_memory, reset_peak_memory, report_stages, read, clean, resolve_validity, validity_key, all_classes, fk_order, sqlite_fast_load, validate, validate_dataset
 from DINO2.tools.export import csv, wikitable
 from DINO2.types import DinoDate, DinoTimeDelta, TypeEnum, IntEnum
 
@@ -23,6 +38,62 @@ def db_obj():
     yield Database(_test_dburl)
     os.remove(path)
 
+def test_clean():
+    stops = DataFrame({"STOP_NR": Series([1, -1, None], dtype='Int64'), "STOP_NAME": [" a ", None, "b"], "STOP_POS_X": [" -1", "7.1 ", None]})
+    clean(stops, Stop)
+    assert stops["STOP_NR"].tolist()[0] == 1 and isna(stops["STOP_NR"][1]) and isna(stops["STOP_NR"][2])
+    assert stops["STOP_NAME"][0] == "a" and isna(stops["STOP_NAME"][1])
+    # "-1" strings are kept, as str_minus_1_to_null has never been applied on import
+    assert stops["STOP_POS_X"][0] == "-1" and stops["STOP_POS_X"][1] == "7.1" and isna(stops["STOP_POS_X"][2])
+    names = DataFrame({"ADD_STOP_NAME_WITHOUT_LOCALITY": [None, " x"]})
+    clean(names, StopAdditionalName)
+    assert names["ADD_STOP_NAME_WITHOUT_LOCALITY"].tolist() == ["", "x"]
+    course_stops = DataFrame({"STOPPING_POINT_TYPE": Series([-1, 0], dtype='Int64'), "LENGTH": Series([-1, 0], dtype='Int64')})
+    clean(course_stops, CourseStop)
+    assert course_stops["STOPPING_POINT_TYPE"].tolist() == [-1, 0]
+    assert isna(course_stops["LENGTH"][0]) and course_stops["LENGTH"][1] == 0
+
+def test_resolve_validity():
+    assert validity_key(Stop) == ["VERSION", "STOP_NR"]
+    assert validity_key(StopArea) == ["VERSION", "STOP_NR", "STOP_AREA_NR"]
+    assert validity_key(StopPoint) == ["VERSION", "STOP_NR", "STOPPING_POINT_NR"]
+    assert validity_key(CourseStop) is None
+    # route.din has VALID_FROM/VALID_TO as well, but duplicate courses are still an error
+    assert validity_key(Course) is None
+    stops = DataFrame({
+        "VERSION": [9, 9, 9, 9, 9, 9, 9],
+        "STOP_NR": [1, 1, 2, 2, 3, 3, 4],
+        "VALID_FROM": ["20200101", "20190101", "20180101", "20190101", "20210101", None, "20300101"],
+        "VALID_TO": ["20201231", "20191231", "20181231", "20191231", "20211231", "20191231", "20301231"],
+    })
+    resolved = resolve_validity(stops, ["VERSION", "STOP_NR"], today=date(2020, 6, 1))
+    # currently valid, most recently valid, once valid over not yet valid, only row
+    assert resolved.index.tolist() == [0, 3, 5, 6]
+
+def test_read_versions(tmp_path, capsys):
+    dinodir = "./tests/data/2020-05-15-version-9"
+    with open(f"{dinodir}/trip.din", "rb") as f:
+        header, *lines = f.read().splitlines(keepends=True)
+    with open(tmp_path / "trip.din", "wb") as f:
+        f.write(header.replace(b"VERSION;", b"VERSION;EXTRA;", 1))
+        for v in (8, 9, 10):
+            f.writelines(f"{v};x;".encode() + line.split(b";", 1)[1] for line in lines)
+    expected = read(dinodir, Trip, "windows-1252")
+    assert_frame_equal(read(str(tmp_path), Trip, "windows-1252", version_ids={9}), expected)
+    assert "Unexpected column 'EXTRA'" in capsys.readouterr().out
+    chunks = list(read(str(tmp_path), Trip, "windows-1252", chunksize=1000, version_ids={8, 10}, warn=False))
+    assert sum(c.shape[0] for c in chunks) == 2 * expected.shape[0]
+    assert "Unexpected" not in capsys.readouterr().out
+    assert len(parse(str(tmp_path), Trip, "windows-1252", version_ids={9}, warn=False)) == expected.shape[0]
+    assert "warning" not in capsys.readouterr().out
+
+def test_fk_order():
+    ordered = fk_order(all_classes())
+    assert set(ordered) == set(all_classes())
+    tables = [cls.__table__ for cls in ordered]
+    for i, table in enumerate(tables):
+        assert all(fk.referred_table in tables[:i + 1] for fk in table.foreign_key_constraints)
+
 def test_import_clear():
     argv = ["<python>", _test_dburl, None, "c"]
     main(argv)
@@ -46,6 +117,454 @@ def test_dataset_counts(db_obj):
     assert len(version.trips) == 4938
     session.close()
 
+def _row_counts(db):
+    with db.engine.connect() as con:
+        return {table.name: con.execute(select([func.count()]).select_from(table)).scalar() for table in Base.metadata.sorted_tables}
+
+@pytest.mark.parametrize("option", ["--chunksize=1000", "--processes=2", "--backend=core", "--backend=copy"])
+def test_import_options(db_obj, tmp_path, option):
+    dburl = f"sqlite:///{tmp_path}/options.db"
+    main(["<python>", dburl, "./tests/data/2020-05-15-version-9", "a", option, f"--report={tmp_path / 'report.json'}"])
+    counts = _row_counts(Database(dburl))
+    assert counts == _row_counts(db_obj)
+    with open(tmp_path / "report.json") as f:
+        tables = json.load(f)["tables"]
+    assert {t["din_file"]: t["rows"] for t in tables} == {cls._din_file: counts[cls.__tablename__] for cls in all_classes()}
+    assert all(set(t["stages"]) == set(report_stages) and t["seconds"] >= 0 for t in tables)
+    assert all(t["peak_memory"] > 0 and t["peak_memory_cumulative"] != reset_peak_memory() for t in tables)
+
+def test_peak_memory():
+    if not reset_peak_memory():
+        pytest.skip("peak memory can't be reset here")
+    before = peak_memory()
+    data = ones(2**25)
+    high = peak_memory()
+    del data
+    assert high >= before + 2**28
+    assert reset_peak_memory() and peak_memory() < high - 2**27
+
+def test_imp_parallel_window(db_obj, tmp_path, monkeypatch):
+    in_flight, peak = set(), [0]
+
+    # futures submitted and not taken for inserting yet
+    class Pool(imp_module.ProcessPoolExecutor):
+        def submit(self, *args):
+            future = super().submit(*args)
+            result = future.result
+
+            def taken():
+                in_flight.discard(future)
+                return result()
+            future.result = taken
+            in_flight.add(future)
+            peak[0] = max(peak[0], len(in_flight))
+            return future
+    monkeypatch.setattr(imp_module, "ProcessPoolExecutor", Pool)
+    dburl = f"sqlite:///{tmp_path}/parallel.db"
+    main(["<python>", dburl, "./tests/data/2020-05-15-version-9", "a", "--processes=2"])
+    assert _row_counts(Database(dburl)) == _row_counts(db_obj)
+    assert peak[0] == 2 and not in_flight
+
+@pytest.mark.parametrize("chunksize", [1, 2, 5])
+def test_imp_chunked_duplicates(db_obj, tmp_path, chunksize):
+    dinodir = tmp_path / "data"
+    copytree("./tests/data/2020-05-15-version-9", dinodir)
+    header, *lines = (dinodir / "fare_zone.din").read_bytes().splitlines(keepends=True)
+    # duplicates of rows of earlier chunks (with chunksize 1 all of them), and of the row before
+    (dinodir / "fare_zone.din").write_bytes(b"".join([header, *lines, lines[0], lines[0], lines[-1], lines[3], lines[1]]))
+    db = Database(f"sqlite:///{tmp_path}/chunked.db")
+    Base.metadata.create_all(db.engine, tables=[Version.__table__, FareZone.__table__])
+    with db.Session() as session, db_obj.Session() as expected:
+        report = imp_chunked(str(dinodir), FareZone, session, dataset_encoding(str(dinodir)), chunksize=chunksize)
+        assert report.rows == session.query(FareZone).count() == expected.query(FareZone).count() == len(lines)
+        assert sorted(session.execute(select([FareZone.__table__]))) == sorted(expected.execute(select([FareZone.__table__])))
+
+def test_sqlite_fast_load(db_obj, tmp_path):
+    dburl = f"sqlite:///{tmp_path}/fast_load.db"
+    db = Database(dburl)
+    with db.engine.connect() as con:
+        synchronous = con.exec_driver_sql("PRAGMA synchronous").scalar()
+        with sqlite_fast_load(con):
+            assert con.exec_driver_sql("PRAGMA synchronous").scalar() == 0
+        assert con.exec_driver_sql("PRAGMA synchronous").scalar() == synchronous
+    main(["<python>", dburl, "./tests/data/2020-05-15-version-9", "a", "--sqlite-fast-load"])
+    assert _row_counts(db) == _row_counts(db_obj)
+    main(["<python>", dburl, None, "c"])
+    # the test data has trip_vdt rows without trip
+    with pytest.raises(ValueError, match="trip_vdt"):
+        main(["<python>", dburl, "./tests/data/2020-05-15-version-9", "a", "--sqlite-fast-load", "--check-foreign-keys"])
+    assert not any(_row_counts(db).values())
+    # tables would be committed before the check
+    for option in ("--backend=core", "--backend=copy", "--resume"):
+        with pytest.raises(ValueError, match="--check-foreign-keys needs one transaction"):
+            main(["<python>", dburl, "./tests/data/2020-05-15-version-9", "a", option, "--check-foreign-keys"])
+        assert not any(_row_counts(db).values())
+
+@pytest.mark.parametrize("packing, option", [("zip", "--processes=2"), ("gz", "--chunksize=1000")])
+def test_import_archive(db_obj, tmp_path, packing, option):
+    dinodir = "./tests/data/2020-05-15-version-9"
+    if packing == "zip":
+        source = str(tmp_path / "dino.zip")
+        with ZipFile(source, "w", ZIP_DEFLATED) as archive:
+            for name in os.listdir(dinodir):
+                archive.write(f"{dinodir}/{name}", f"dino/{name}")
+    else:
+        source = str(tmp_path)
+        for name in os.listdir(dinodir):
+            with open(f"{dinodir}/{name}", "rb") as f, gzip_open(tmp_path / f"{name}.gz", "wb") as gz:
+                copyfileobj(f, gz)
+    dburl = f"sqlite:///{tmp_path}/archive.db"
+    main(["<python>", dburl, source, "a", option])
+    assert _row_counts(Database(dburl)) == _row_counts(db_obj)
+
+def test_incremental(db_obj, tmp_path, capsys):
+    dinodir = tmp_path / "data"
+    copytree("./tests/data/2020-05-15-version-9", dinodir)
+    dburl = f"sqlite:///{tmp_path}/incremental.db"
+    db = Database(dburl)
+    main(["<python>", dburl, str(dinodir), "a", "--incremental"])
+    assert _row_counts(db) == _row_counts(db_obj)
+    capsys.readouterr()
+    main(["<python>", dburl, str(dinodir), "a", "--incremental"])
+    assert "importing" not in capsys.readouterr().out
+    assert _row_counts(db) == _row_counts(db_obj)
+    lines = (dinodir / "trip_vdt.din").read_bytes().splitlines(keepends=True)
+    (dinodir / "trip_vdt.din").write_bytes(b"".join(lines[:-1]))
+    main(["<python>", dburl, str(dinodir), "a", "--incremental"])
+    out = capsys.readouterr().out
+    assert out.count("importing") == 1 and "trip_vdt.din" in out
+    counts, expected = _row_counts(db), _row_counts(db_obj)
+    assert counts.pop("trip_vdt") == expected.pop("trip_vdt") - 1
+    assert counts == expected
+
+def test_incremental_foreign_keys(db_obj, tmp_path, capsys):
+    dinodir = tmp_path / "data"
+    copytree("./tests/data/2020-05-15-version-9", dinodir)
+    # tables whose foreign keys SQLite can enforce, see test_import_postgres_copy
+    classes = [Version, DayType, DayAttribute, DayGrouping, CalendarDay, FareZone, Stop, StopAdditionalName, StopArea, StopPoint]
+    db = Database(f"sqlite:///{tmp_path}/incremental_fk.db", fk=True)
+    Base.metadata.create_all(db.engine, tables=[cls.__table__ for cls in classes])
+    with db.Session() as session, session.begin():
+        imp(str(dinodir), classes, session, incremental=True)
+    header, first, *lines = (dinodir / "stop.din").read_bytes().splitlines(keepends=True)
+    fields = first.split(b";")
+    fields[5] = b"CHANGED "
+    (dinodir / "stop.din").write_bytes(b"".join([header, b";".join(fields), *lines]))
+    capsys.readouterr()
+    with db.Session() as session, session.begin():
+        imp(str(dinodir), classes, session, incremental=True)
+    out = capsys.readouterr().out
+    assert "reloaded for foreign keys: StopAdditionalName, StopArea, StopPoint" in out
+    assert out.count("importing") == 4 and "FareZone" not in out.split("classes: ")[1]
+    with db.Session() as session, db_obj.Session() as expected:
+        for cls in classes:
+            assert session.query(cls).count() == expected.query(cls).count()
+        assert session.query(Stop).filter_by(version_id=9, id=int(fields[1])).one().abbr == "CHANGED"
+
+def test_incremental_restriction_days(db_obj, tmp_path, capsys):
+    dinodir = tmp_path / "data"
+    copytree("./tests/data/2020-05-15-version-9", dinodir)
+    classes = [Version, Restriction]
+    db = Database(f"sqlite:///{tmp_path}/incremental_restriction_days.db", fk=True)
+    Base.metadata.create_all(db.engine, tables=[Version.__table__, Restriction.__table__, RestrictionDay.__table__])
+    with db.Session() as session, session.begin():
+        imp(str(dinodir), classes, session, incremental=True, restriction_days=True)
+    header, first = (dinodir / "version.din").read_bytes().splitlines(keepends=True)
+    (dinodir / "version.din").write_bytes(header + first.replace(b"Sommerfahrplan", b"Sommer"))
+    capsys.readouterr()
+    # only version.din changed, restriction days still refer to the reloaded restrictions
+    with db.Session() as session, session.begin():
+        imp(str(dinodir), classes, session, incremental=True, restriction_days=True)
+    assert "reloaded for foreign keys: Restriction" in capsys.readouterr().out
+    with db.Session() as session, db_obj.Session() as expected:
+        assert session.query(Restriction).count() == expected.query(Restriction).count()
+        assert session.query(RestrictionDay).count() == sum(len(r.bitset) for r in session.query(Restriction))
+
+def test_import_minus_1_coordinate(tmp_path):
+    dinodir = tmp_path / "data"
+    copytree("./tests/data/2020-05-15-version-9", dinodir)
+    header, first, *lines = (dinodir / "link_force_point.din").read_bytes().splitlines(keepends=True)
+    fields = first.split(b";")
+    fields[3:5] = [b"-1", b"-1"]
+    (dinodir / "link_force_point.din").write_bytes(b"".join([header, b";".join(fields), *lines]))
+    dburl = f"sqlite:///{tmp_path}/minus_1.db"
+    db = Database(dburl)
+    main(["<python>", dburl, str(dinodir), "a"])
+    session = db.Session()
+    point = session.query(LinkForcePoint).order_by(LinkForcePoint.link_id, LinkForcePoint.consec_pt_nr).first()
+    assert (point.pos_x, point.pos_y) == ("-1", "-1")
+    session.close()
+
+def test_copy_csv():
+    rows = [{"VERSION": 9, "STOP_NR": 1, "ADD_STOP_NAME_WITH_LOCALITY": 'a "b", c', "ADD_STOP_NAME_WITHOUT_LOCALITY": ""}]
+    assert copy_csv(StopAdditionalName.__table__, rows, postgresql.dialect()) == '9,1,"a ""b"", c",""\n'
+    rows = [{"VERSION": 9, "STOP_NR": 1, "VALID_FROM": date(2020, 1, 2)}]
+    assert copy_csv(Stop.__table__, rows, postgresql.dialect()).split(",")[16:19] == ["", '"20200102"', ""]
+
+def test_import_postgres_copy(db_obj):
+    pytest.importorskip("psycopg2")
+    dburl = os.environ.get("DINO2_TEST_POSTGRES", "postgresql:///dino2_test")
+    db = Database(dburl)
+    try:
+        db.engine.connect().close()
+    except OperationalError:
+        pytest.skip(f"no PostgreSQL database at {dburl} (set DINO2_TEST_POSTGRES)")
+    # tables whose keys PostgreSQL accepts (no nullable primary key columns or foreign keys to non-unique columns), and which the test data satisfies
+    classes = [Version, DayType, DayAttribute, DayGrouping, CalendarDay, FareZone, Stop, StopAdditionalName, StopArea, StopPoint]
+    tables = [cls.__table__ for cls in classes]
+    Base.metadata.create_all(db.engine, tables=tables)
+    try:
+        with db.Session() as session:
+            imp("./tests/data/2020-05-15-version-9", classes, session, backend="copy")
+            session.commit()
+        with db.engine.connect() as con, db_obj.engine.connect() as expected:
+            for table in tables:
+                assert sorted(con.execute(select([table]))) == sorted(expected.execute(select([table])))
+    finally:
+        Base.metadata.drop_all(db.engine, tables=tables)
+        db.engine.dispose()
+
+def test_resume(db_obj, tmp_path, monkeypatch, capsys):
+    dburl = f"sqlite:///{tmp_path}/resume.db"
+    dinodir = "./tests/data/2020-05-15-version-9"
+    db = Database(dburl)
+    parse = imp_module.parse
+
+    def failing_parse(dinodir, cls, *args, **kwargs):
+        if cls is TripVDT:
+            raise RuntimeError("interrupted")
+        return parse(dinodir, cls, *args, **kwargs)
+    monkeypatch.setattr(imp_module, "parse", failing_parse)
+    with pytest.raises(RuntimeError, match="interrupted"):
+        main(["<python>", dburl, dinodir, "a", "--resume"])
+    counts, expected = _row_counts(db), _row_counts(db_obj)
+    assert counts.pop("trip_vdt") == 0 and expected.pop("trip_vdt")
+    assert counts == expected
+    monkeypatch.setattr(imp_module, "parse", parse)
+    capsys.readouterr()
+    main(["<python>", dburl, dinodir, "a", "--resume"])
+    out = capsys.readouterr().out
+    assert out.count("importing") == 1 and "trip_vdt.din" in out
+    assert _row_counts(db) == _row_counts(db_obj)
+    main(["<python>", dburl, dinodir, "9", "--rollback"])
+    assert not any(_row_counts(db).values())
+    with db.engine.connect() as con:
+        assert not con.execute(select([func.count()]).select_from(checkpoints)).scalar()
+
+def test_restriction_days(db_obj, tmp_path):
+    dburl = f"sqlite:///{tmp_path}/restriction_days.db"
+    db = Database(dburl)
+    main(["<python>", dburl, "./tests/data/2020-05-15-version-9", "a", "--restriction-days"])
+    session, expected = db.Session(), db_obj.Session()
+    days = session.query(RestrictionDay).count()
+    assert days == sum(len(r.bitset) for r in session.query(Restriction))
+    # rebuilt in batches of 7 rows
+    assert materialize_restriction_days(session, chunksize=7) == days == session.query(RestrictionDay).count()
+    for day in (date(2020, 6, 14), date(2020, 6, 15), date(2020, 7, 1), date(2020, 12, 24)):
+        trips = set((t.version_id, t.line, t.id) for t in Trip.query_for_date(session, day))
+        assert trips == set((t.version_id, t.line, t.id) for t in Trip.query_for_date(expected, day))
+    # materialized versions are looked up once per transaction
+    assert session.info["DINO2_cache"]["restriction_day_versions"] == {9} and expected.info["DINO2_cache"]["restriction_day_versions"] == set()
+    session.commit()
+    assert "DINO2_cache" not in session.info
+    session.close()
+    expected.close()
+
+def test_line_restrictions(tmp_path):
+    dinodir = tmp_path / "data"
+    copytree("./tests/data/2020-05-15-version-9", dinodir)
+    header, *lines = (dinodir / "service_restriction.din").read_bytes().splitlines(keepends=True)
+    for i, line in enumerate(lines):
+        fields = line.split(b";")
+        if fields[1].strip() in (b"T0", b"82"):
+            fields[10] = b"999999" if fields[1].strip() == b"T0" else b"50538"
+            lines[i] = b";".join(fields)
+    (dinodir / "service_restriction.din").write_bytes(b"".join([header, *lines]))
+    for option in ([], ["--restriction-days"]):
+        dburl = f"sqlite:///{tmp_path}/line_restrictions{len(option)}.db"
+        db = Database(dburl)
+        main(["<python>", dburl, str(dinodir), "a", *option])
+        session = db.Session()
+        service_days = session.query(Version).get(9).service_days
+        unrestricted = session.query(Trip).filter_by(restriction_id="T0").first()
+        assert unrestricted.restriction is None and service_days.count(unrestricted) == len(unrestricted.dates) > 0
+        specific = session.query(Trip).filter_by(restriction_id="82").one()
+        assert specific.restriction.line == 50538 and service_days.bitset(specific).dates == specific.restriction.dates
+        for day in (date(2020, 6, 14), date(2020, 6, 15), date(2020, 7, 1), date(2020, 7, 20)):
+            trips = set((t.line, t.id) for t in Trip.query_for_date(session, day))
+            assert trips == set(service_days.trips_on(day))
+            assert ((unrestricted.line, unrestricted.id) in trips) == (day in unrestricted.dates)
+            assert ((specific.line, specific.id) in trips) == (day in specific.dates)
+        if option:
+            # materialized versions are looked up again in the next transaction
+            session.commit()
+            RestrictionDay.__table__.drop(db.engine)
+            day = date(2020, 7, 1)
+            assert set((t.line, t.id) for t in Trip.query_for_date(session, day)) == set(service_days.trips_on(day))
+        session.close()
+
+def test_service_days(db_obj):
+    session = db_obj.Session()
+    version = session.query(Version).get(9)
+    service_days = version.service_days
+    assert version.service_days is service_days
+    trips = session.query(Trip).filter_by(version_id=9).all()
+    assert len(service_days) == len(trips)
+    for trip in trips:
+        dates = trip.dates
+        assert service_days.bitset(trip).dates == dates and service_days.count(trip) == len(dates)
+    day = date(2020, 7, 1)
+    running = set(service_days.trips_on(day))
+    assert running == set((t.line, t.id) for t in Trip.query_for_date(session, day))
+    assert all(service_days.runs_on(key, day) for key in running)
+    assert not service_days.runs_on(trips[0], date(2000, 1, 1)) and service_days.trips_on(date(2000, 1, 1)) == []
+    classes = service_days.day_classes()
+    assert sum(len(dc.dates) for dc in classes) == service_days.days and len(classes) < 10
+    for dc in classes:
+        assert all(set(service_days.trips_on(d)) == set(dc.trips) for d in dc.dates)
+    week = service_days.day_classes(date(2020, 6, 14), date(2020, 6, 20))
+    assert sorted(d for dc in week for d in dc.dates) == [date(2020, 6, 14) + timedelta(days=n) for n in range(7)]
+    assert service_days.day_classes(date(2000, 1, 1), date(2000, 1, 31)) == []
+    session.close()
+
+def test_query_for_dates(db_obj):
+    session = db_obj.Session()
+    result = Trip.query_for_dates(session, date(2020, 6, 12), date(2020, 6, 22))
+    assert not isinstance(result, (list, dict))
+    days = []
+    for day, trips in result:
+        days.append(day)
+        assert set((t.version_id, t.line, t.id) for t in trips) == set((t.version_id, t.line, t.id) for t in Trip.query_for_date(session, day))
+    assert days == [date(2020, 6, 12) + timedelta(days=n) for n in range(11)]
+    line = dict(Trip.query_for_dates(session, date(2020, 6, 15), date(2020, 6, 15), session.query(Trip).filter_by(line=50514)))
+    assert len(line[date(2020, 6, 15)]) > 0 and all(t.line == 50514 for t in line[date(2020, 6, 15)])
+    # a single version is always effective within its period
+    day = date(2020, 7, 1)
+    assert Trip.query_for_date(session, day, resolve_priority=True).count() == Trip.query_for_date(session, day).count() > 0
+    assert [len(trips) for _, trips in Trip.query_for_dates(session, day, day, resolve_priority=True)] == [Trip.query_for_date(session, day).count()]
+    session.close()
+
+def test_trip_stops_for(db_obj):
+    session = db_obj.Session()
+    trips = session.query(Trip).filter_by(version_id=9, line=50514).all()
+    for simple in (False, True):
+        trip_stops = Trip.trip_stops_for(trips, simple=simple, batchsize=50)
+        assert list(trip_stops) == trips
+        assert all(trip_stops[trip] == trip.trip_stops(simple=simple) for trip in trips)
+    assert Trip.trip_stops_for([]) == {}
+    session.close()
+
+def test_stop_time_patterns(db_obj):
+    session = db_obj.Session()
+    version = session.query(Version).get(9)
+    patterns = version.stop_time_patterns
+    assert version.stop_time_patterns is patterns and len(patterns) > 0
+    for trip in session.query(Trip).filter_by(version_id=9, line=50514):
+        arrival, departure = trip.stop_times()
+        expected = [(ts.arr_time, ts.dep_time, ts.distance_travelled) for ts in trip.trip_stops()]
+        assert [
+            (None if isna(a) else timedelta(seconds=a), None if isna(d) else timedelta(seconds=d), None if isna(m) else int(m))
+            for a, d, m in zip(arrival, departure, trip.stop_time_pattern.distance)] == expected
+        assert trip.duration == sum(((t.time_to_stop + t.stopping_time) for t in trip.stop_timings if t.time_to_stop is not None), timedelta())
+    assert len(trip.course.stop_time_pattern(-5)) == 0 and trip.course.duration(-5) == timedelta()
+    # usable in sets and comparisons despite their arrays
+    pattern = trip.stop_time_pattern
+    assert pattern == trip.stop_time_pattern and pattern != trip.course.stop_time_pattern(-5) and pattern in {pattern}
+    session.close()
+
+def test_timetable(db_obj):
+    session = db_obj.Session()
+    timetable = Timetable.for_version(session, 9)
+    assert len(timetable) == session.query(Trip).filter_by(version_id=9).count()
+    trip = session.query(Trip).filter_by(version_id=9, line=50514).first()
+    i = timetable.trip_keys.index((trip.line, trip.id))
+    events = slice(timetable.trip_events[i], timetable.trip_events[i+1])
+    arrival, departure = trip.stop_times()
+    assert_array_equal(timetable.arrival[events], arrival)
+    assert_array_equal(timetable.departure[events], departure)
+    assert timetable.stop_ids[timetable.event_stop[events]].tolist() == [ts.stop.id for ts in trip.trip_stops()]
+    # same departures as csv.departures for one day
+    day = date(2020, 6, 15)
+    departures = timetable.departures(2216, timetable.trips_on(day))
+    expected = []
+    running = set(session.query(Version).get(9).service_days.trips_on(day))
+    serving = session.query(Trip).filter(Trip.version_id == 9, Trip.course.has(Course.stops.any(CourseStop.stop_id == 2216))).all()
+    for tripstops in Trip.trip_stops_for([t for t in serving if (t.line, t.id) in running], simple=True).values():
+        expected.extend(ts.dep_time.total_seconds() for n, ts in enumerate(tripstops, start=1) if ts.stop.id == 2216 and n != len(tripstops))
+    assert timetable.departure[departures].tolist() == sorted(expected) and len(expected) > 0
+    assert (timetable.headways(2216, timetable.trips_on(day)) >= 0).all()
+    assert timetable.departures(2216, start=8 * 3600, end=9 * 3600).size < timetable.departures(2216).size
+    assert timetable.stop_index(-100) == -1 and timetable.departures(-100).size == 0
+    assert round(timetable.vehicle_km(days=True), 2) == 5102838.19
+    session.close()
+
+def test_link_lookup(db_obj):
+    session = db_obj.Session()
+    version = session.query(Version).get(9)
+    lookup = version.link_lookup
+    assert version.link_lookup is lookup
+    courses = session.query(Course).filter_by(version_id=9, line=50514).all()
+    lookup.prefetch(courses)
+    assert len(lookup.links) > 0 and not lookup.missing
+    # only key columns, coordinates come from the LinkGeometryStore
+    assert all({"geometry", "force_points", "length"} <= inspect(link).unloaded for link in lookup.links.values())
+    for course in courses:
+        links = lookup.course_links(course)
+        for (s_f, s_t), link in zip(zip(course.stops, course.stops[1:]), links):
+            assert (link.from_stop_id, link.from_point_id, link.to_stop_id, link.to_point_id) == (s_f.stop_id, s_f.stop_point_id, s_t.stop_id, s_t.stop_point_id)
+        assert course.wkt == f"MULTILINESTRING ({', '.join(link.wkt[11:] for link in links if link.geometry or link.force_points)})"
+    assert lookup.get((-1, -1, -2, -2)) is None and lookup.missing == {(-1, -1, -2, -2)}
+    session.close()
+
+def test_link_geometry_store(db_obj):
+    session = db_obj.Session()
+    version = session.query(Version).get(9)
+    store = version.link_geometry
+    assert version.link_geometry is store and len(store) > 0
+    for link in session.query(Link).filter(Link.version_id == 9, Link.id.in_(store.link_ids.tolist())):
+        assert store.wkt(link.id) == link.wkt
+        points = link.geometry or link.force_points
+        assert store.coordinates(link.id) == [[float(p.pos_x), float(p.pos_y)] for p in points]
+        wkb = store.wkb(link.id)
+        assert unpack_from("<BII", wkb) == (1, 2, len(points)) and len(wkb) == 9 + 16 * len(points)
+    assert store.wkt(-1) == "LINESTRING EMPTY" and store.points(-1).shape == (0, 2) and store.multi_wkt([-1]) == "MULTILINESTRING EMPTY"
+    link_ids = store.link_ids[:2].tolist()
+    assert store.multi_wkt(link_ids) == f"MULTILINESTRING ({', '.join(store.wkt(i)[11:] for i in link_ids)})"
+    assert store.multi_wkb(link_ids) == pack("<BII", 1, 5, 2) + store.wkb(link_ids[0]) + store.wkb(link_ids[1])
+    course = session.query(Course).filter_by(version_id=9, line=50514).first()
+    links = version.link_lookup.course_links(course)
+    assert course.wkt == store.multi_wkt(link.id for link in links)
+    assert course.wkt_m(1).startswith("MULTILINESTRING M ((") and course.wkt_m(1).count("(") == course.wkt.count("(")
+    # links without points are left out of WKT and WKB alike, here the first link of the course with points loses them
+    with_points = [link.id for link in links if len(store.points(link.id))]
+    i = int(store.link_ids.searchsorted(with_points[0]))
+    counts = diff(store.offsets)
+    counts[i] = 0
+    xy, text = concatenate((store.xy[:store.offsets[i]], store.xy[store.offsets[i+1]:])), concatenate((store.text[:store.offsets[i]], store.text[store.offsets[i+1]:]))
+    version._link_geometry = LinkGeometryStore(9, store.link_ids, concatenate(([0], cumsum(counts))), xy, text)
+    assert unpack_from("<BII", course.wkb) == (1, 5, len(with_points) - 1) and course.wkt.count("(") - 1 == len(with_points) - 1
+    assert store.multi_wkb([-1]) == pack("<BII", 1, 5, 0)
+    # coordinates keep the precision of the dataset in WKT
+    short = LinkGeometryStore(9, array([1]), array([0, 1]), array([[7.5, 51.25]]), array(["7.5 51.25"], dtype=object))
+    assert short.wkt(1) == "LINESTRING (7.5 51.25)" and short.multi_wkt_m([(1, 0, 10)]) == "MULTILINESTRING M ((7.5 51.25 0))"
+    session.close()
+
+def test_validate():
+    trips = DataFrame({"VERSION": Series([9, 9, 9], dtype='Int64'), "LINE_NR": Series([1, 1, 2], dtype='Int64'), "TRIP_ID": Series([1, 1, 1], dtype='Int64')})
+    vdts = DataFrame({"VERSION": Series([9, 9, 9], dtype='Int64'), "LINE_NR": Series([1, 3, None], dtype='Int64'), "TRIP_ID": Series([1, 1, 1], dtype='Int64')})
+    violations = validate({Trip: trips, TripVDT: vdts})
+    assert violations["trip(VERSION, LINE_NR, TRIP_ID) primary key"].index.tolist() == [0, 1]
+    assert violations["trip_vdt(VERSION, LINE_NR, TRIP_ID) -> trip(VERSION, LINE_NR, TRIP_ID)"].index.tolist() == [1]
+
+def test_validate_dataset(db_obj, tmp_path):
+    violations = validate_dataset("./tests/data/2020-05-15-version-9", all_classes())
+    # the test data has trip_vdt rows without trip, and neighbour fare zones without fare zone
+    assert {name.split("(")[0]: rows.shape[0] for name, rows in violations.items()} == {"trip_vdt": 1395, "neighbour_fare_zone": 29}
+    dburl = f"sqlite:///{tmp_path}/validate.db"
+    with pytest.raises(ValueError, match="1424 rows violate constraints"):
+        main(["<python>", dburl, "./tests/data/2020-05-15-version-9", "a", "--validate"])
+    assert not any(_row_counts(Database(dburl)).values())
+
 def test_wikitable(db_obj):
     session = db_obj.Session()
     fn = "./tests/data/_test_wiki-9.txt"
@@ -91,6 +610,23 @@ def test_trips(db_obj):
     session.close()
     assert equal
 
+def test_trips_missing_links(db_obj, tmp_path, capsys):
+    copyfile(_test_dburl[10:], tmp_path / "missing_links.db")
+    db = Database(f"sqlite:///{tmp_path}/missing_links.db")
+    session = db.Session()
+    first, second = session.query(Course).filter_by(line=50532).first().stops[:2]
+    session.query(Link).filter_by(from_stop_id=first.stop_id, from_point_id=first.stop_point_id, to_stop_id=second.stop_id, to_point_id=second.stop_point_id).delete()
+    session.commit()
+    capsys.readouterr()
+    csv.trips(session, str(tmp_path / "trips.csv"), date(2020, 6, 15), line_ids={50532})
+    out = capsys.readouterr().out
+    assert out.count("--> warning") == 1
+    assert f"--> warning: version 9: no link between stop points {(first.stop_id, first.stop_point_id, second.stop_id, second.stop_point_id)}\n" in out
+    # pairs of courses of other exports are not reported again
+    csv.trips(session, str(tmp_path / "trips.csv"), date(2020, 6, 15), line_ids={50514})
+    assert "--> warning" not in capsys.readouterr().out
+    session.close()
+
 def test_line_stats(db_obj):
     session = db_obj.Session()
     fn = "./tests/data/_test_line_stats-9.csv"
@@ -2,8 +2,10 @@ import pytest
 
 from datetime import date, timedelta
 from enum import Enum
+from pandas import Series
+from sqlalchemy import Integer
 
-from DINO2.types import DinoDate, DinoTimeDelta, TypeEnum, IntEnum
+from DINO2.types import DinoDate, DinoTimeDelta, TypeEnum, IntEnum, process_result_column
 
 def test_dinodate_prv():
     dd = DinoDate()
@@ -70,3 +72,19 @@ def test_typeenum():
     assert te.process_bind_param(TestEnum.normal) == 1
     with pytest.raises(ValueError):
         te.process_bind_param("normal")
+
+def test_process_result_column():
+    class TestEnum(Enum):
+        default = 0
+        normal = 1
+    dates = Series(['20200229', None, '20200229', '19700101'], dtype=object)
+    assert list(process_result_column(DinoDate(), dates)) == [date(2020, 2, 29), None, date(2020, 2, 29), date(1970, 1, 1)]
+    seconds = Series([60, -1, None], dtype='Int64')
+    assert list(process_result_column(DinoTimeDelta(), seconds)) == [timedelta(minutes=1), timedelta(seconds=-1), None]
+    assert list(process_result_column(DinoTimeDelta(True), seconds)) == [timedelta(minutes=1), None, None]
+    assert list(process_result_column(IntEnum(TestEnum), Series([1, None, 0], dtype='Int64'))) == [TestEnum.normal, None, TestEnum.default]
+    with pytest.raises(ValueError):
+        process_result_column(IntEnum(TestEnum), Series([10], dtype='Int64'))
+    plain = process_result_column(Integer(), seconds)
+    assert list(plain) == [60, -1, None]
+    assert type(plain[0]) == int